@@ -6,3 +6,7 @@ class DHCPConfigInitError(Exception):
 
 class DHCPServerInitError(Exception):
     pass
+
+
+class PcapFormatError(Exception):
+    pass
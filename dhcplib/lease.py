@@ -0,0 +1,571 @@
+import time
+import ipaddress
+import threading
+from array import array
+from itertools import chain
+from collections import namedtuple
+
+
+Lease = namedtuple('Lease', ('ip', 'chaddr', 'state', 'xid', 'end_time'))
+
+
+def mac_to_int(chaddr):
+    """Returns the 48-bit integer form of a 'AA:BB:CC:DD:EE:FF' string."""
+    return int(chaddr.replace(':', ''), 16)
+
+
+def int_to_mac(value):
+    """Returns the 'AA:BB:CC:DD:EE:FF' form of a 48-bit integer."""
+    mac = '{:012X}'.format(value)
+    return ':'.join(mac[index:index + 2] for index in range(0, 12, 2))
+
+
+class LeaseTable(object):
+    """Compact lease store with one slot per pool address.
+
+    Every binding is kept in four typed arrays (structure of arrays)
+    indexed by the offset of the address from the start of the pool:
+
+        state   'B'  1 byte
+        chaddr  'Q'  8 bytes (48-bit MAC)
+        xid     'I'  4 bytes
+        expiry  'q'  8 bytes (integer seconds of the monotonic clock)
+
+    That is 21 bytes per lease, so a /12 pool (1048574 hosts) takes about
+    21 MiB instead of several hundred bytes per lease for a dict binding.
+
+    Expiry is evaluated lazily: a slot whose expiry time has passed is
+    reported as FREE without the table having to be swept on every packet.
+
+    Offers do not scan the arrays either: a dict maps every chaddr to the
+    slot it was last stored in, and free slots are searched next fit, from
+    a cursor left after the previous offer in the same bounds.
+
+    """
+
+    # Binding states.
+    FREE = 0
+    ACTIVE = 1
+    OFFERED = 2
+    RESERVED = 3
+
+    MAX_EXPIRY = (1 << 63) - 1
+
+    STATE_TYPE = 'B'
+    CHADDR_TYPE = 'Q'
+    XID_TYPE = 'I'
+    EXPIRY_TYPE = 'q'
+
+    def __init__(self, start, end, clock=time.monotonic):
+        """LeaseTable initial.
+
+        :param start: first pool address
+        :param end: last pool address (inclusive)
+        :param clock: callable returning the current time in seconds; the
+            default for every 'now' argument, so lookups without one agree
+            with a DHCPServer running on a virtual clock
+
+        """
+        self.clock = clock
+        self.start = ipaddress.IPv4Address(start)
+        self.end = ipaddress.IPv4Address(end)
+        self._base = int(self.start)
+        size = int(self.end) - self._base + 1
+        if size <= 0:
+            raise ValueError('Incorrect address range')
+        self._state = array(self.STATE_TYPE, bytes(size))
+        self._chaddr = array(self.CHADDR_TYPE, [0]) * size
+        self._xid = array(self.XID_TYPE, [0]) * size
+        self._expiry = array(self.EXPIRY_TYPE, [0]) * size
+        self._listeners = []
+        self._load_listeners = []
+        # chaddr -> index of the slot last stored with it.
+        self._owners = {}
+        # (first, last) bounds -> slot index the next free search starts at.
+        self._cursors = {}
+
+    def __len__(self):
+        return len(self._state)
+
+    def __iter__(self):
+        return self.leases()
+
+    @classmethod
+    def bytes_per_lease(cls):
+        return sum(
+            array(typecode).itemsize for typecode in (
+                cls.STATE_TYPE, cls.CHADDR_TYPE, cls.XID_TYPE,
+                cls.EXPIRY_TYPE
+            )
+        )
+
+    @property
+    def nbytes(self):
+        return len(self) * self.bytes_per_lease()
+
+    def now(self):
+        return int(self.clock())
+
+    def index(self, ip):
+        """Returns the slot index of 'ip' or None if it is out of the pool.
+
+        :param ip: IPv4Address, dotted string or integer
+
+        """
+        if isinstance(ip, str):
+            ip = ipaddress.IPv4Address(ip)
+        index = int(ip) - self._base
+        if 0 <= index < len(self._state):
+            return index
+        return None
+
+    def address(self, index):
+        return ipaddress.IPv4Address(self._base + index)
+
+    def state(self, index, now=None):
+        state = self._state[index]
+        if state != self.FREE:
+            if (self.now() if now is None else now) > self._expiry[index]:
+                return self.FREE
+        return state
+
+    def get(self, ip, now=None):
+        """Returns a Lease record for 'ip' or None if the slot is unused."""
+        index = self.index(ip)
+        if index is None or not self._is_used(index):
+            return None
+        return self._record(index, now)
+
+    def offer(self, chaddr, xid, timeout, now=None, share=None,
+              bounds=None):
+        """Reserves an address for 'chaddr' and returns its slot index.
+
+        The slot already bound to 'chaddr' is reused, otherwise the next
+        free one after the previous offer is taken.
+
+        :param chaddr: client hardware address as 48-bit integer
+        :param xid: transaction ID of the DHCPDISCOVER
+        :param timeout: seconds the offer stays reserved
+        :param now: monotonic timestamp, defaults to the current one
+        :param share: (part, parts) tuple limiting free slots to those with
+            index % parts == part; slots bound to 'chaddr' always match
+        :param bounds: (first, last) slot indexes the search is limited to
+
+        """
+        now = self.now() if now is None else now
+        part, parts = share or (0, 1)
+        first, last = bounds or (0, len(self._state) - 1)
+        last = min(last, len(self._state) - 1)
+        while True:
+            index = self._find(chaddr, now, part, parts, first, last)
+            if index is None:
+                return None
+            # A failed claim means another writer took the slot meanwhile,
+            # the next search sees its write.
+            if self._claim(index, chaddr, xid, timeout, now, part, parts):
+                return index
+
+    def _find(self, chaddr, now, part, parts, first, last):
+        """Returns the slot in [first, last] 'chaddr' may be offered.
+
+        A slot already bound to 'chaddr' is preferred over a free one.
+
+        """
+        index = self._owners.get(chaddr)
+        if (index is not None and first <= index <= last
+                and self._chaddr[index] == chaddr
+                and self._state[index] != self.RESERVED):
+            return index
+        return self._find_free(now, part, parts, first, last)
+
+    def _find_free(self, now, part, parts, first, last):
+        """Returns a free slot in [first, last] with index % parts == part.
+
+        The search starts at the cursor of the bounds and wraps around once,
+        so filling the pool costs one pass over it instead of one per offer.
+
+        """
+        state = self._state
+        expiry = self._expiry
+        free = self.FREE
+        bounds = (first, last)
+        cursor = self._cursors.get(bounds, first)
+        if not first <= cursor <= last:
+            cursor = first
+        cursor += (part - cursor) % parts
+        start = first + (part - first) % parts
+        for index in chain(range(cursor, last + 1, parts),
+                           range(start, min(cursor, last + 1), parts)):
+            if state[index] == free or now > expiry[index]:
+                self._cursors[bounds] = index + 1
+                return index
+        return None
+
+    def _available(self, index, chaddr, now, part, parts):
+        """Checks that slot 'index' may still be offered to 'chaddr'."""
+        state = self._state[index]
+        if self._chaddr[index] == chaddr:
+            return state != self.RESERVED
+        return ((state == self.FREE or now > self._expiry[index])
+                and index % parts == part)
+
+    def _claim(self, index, chaddr, xid, timeout, now, part, parts):
+        self._set(index, chaddr, self.OFFERED, xid, now + timeout)
+        return True
+
+    def match(self, index, chaddr, xid=None):
+        """Checks that the slot is bound to 'chaddr' (and 'xid' if given)."""
+        if not self._is_used(index) or self._chaddr[index] != chaddr:
+            return False
+        if xid is not None and self._xid[index] != xid:
+            return False
+        return True
+
+    def bind(self, index, chaddr, xid, lease_time, now=None):
+        """Turns an offered slot into an active lease or extends one.
+
+        :param xid: transaction ID to check, None to skip the check
+        :return: True if the slot was bound to 'chaddr' and 'xid'
+
+        """
+        if not self.match(index, chaddr, xid):
+            return False
+        now = self.now() if now is None else now
+        self._state[index] = self.ACTIVE
+        self._expiry[index] = now + lease_time
+        self._notify(index)
+        return True
+
+    def release(self, index, chaddr):
+        if not self.match(index, chaddr):
+            return False
+        self._state[index] = self.FREE
+        self._notify(index)
+        return True
+
+    def decline(self, index, chaddr):
+        if not self.match(index, chaddr):
+            return False
+        self._state[index] = self.ACTIVE
+        self._notify(index)
+        return True
+
+    def reserve(self, index):
+        """Takes the slot out of the pool for good."""
+        self._set(index, 0, self.RESERVED, 0, self.MAX_EXPIRY)
+
+    def unreserve(self, index):
+        """Returns a reserved slot to the pool."""
+        if self._state[index] == self.RESERVED:
+            self._set(index, 0, self.FREE, 0, 0)
+
+    def resize(self, start, end, now=None):
+        """Moves the pool bounds, keeping the bindings of the overlap.
+
+        Only the removed and added ranges are touched: slots are deleted
+        from or inserted at the ends of the arrays in place. Slot indexes
+        change when 'start' moves, so index based listeners (LeaseIndex,
+        LeaseReplicator) must be rebuilt afterwards.
+
+        A slot index taken before the call may point past the end of the
+        arrays or at another address afterwards. On a plain LeaseTable the
+        resize must not run concurrently with any other call, e.g. with a
+        DHCPServer handler on another thread; ConcurrentLeaseTable
+        re-checks indexes instead.
+
+        :param start: new first pool address
+        :param end: new last pool address (inclusive)
+        :return: list of Lease records of the offered and active bindings
+            that fell out of the pool
+
+        """
+        start = ipaddress.IPv4Address(start)
+        end = ipaddress.IPv4Address(end)
+        size = int(end) - int(start) + 1
+        if size <= 0:
+            raise ValueError('Incorrect address range')
+        now = self.now() if now is None else now
+        length = len(self._state)
+        head = int(start) - self._base
+        removed = chain(
+            range(0, min(max(head, 0), length)),
+            range(min(max(head + size, 0), length), length)
+        )
+        evicted = [self._record(index, now) for index in removed
+                   if self._is_used(index)
+                   and self.state(index, now) != self.FREE]
+
+        for name, typecode in (('_state', self.STATE_TYPE),
+                               ('_chaddr', self.CHADDR_TYPE),
+                               ('_xid', self.XID_TYPE),
+                               ('_expiry', self.EXPIRY_TYPE)):
+            values = getattr(self, name)
+            if head > 0:
+                del values[:head]
+            elif head < 0:
+                values[0:0] = array(typecode, [0]) * -head
+            if len(values) > size:
+                del values[size:]
+            else:
+                values.extend(array(typecode, [0]) * (size - len(values)))
+        self._owners = {
+            chaddr: index - head for chaddr, index in self._owners.items()
+            if 0 <= index - head < size
+        }
+        self._cursors = {}
+        self.start = start
+        self.end = end
+        self._base = int(start)
+        return evicted
+
+    def subscribe(self, listener, loads=False):
+        """Registers a callable invoked with the slot index on every change.
+
+        Expiry is not a change: every holder of the table expires lazily.
+
+        :param loads: also invoke it for 'load', i.e. for bindings written
+            by the replicator; the replicator itself must not see them
+
+        """
+        self._listeners.append(listener)
+        if loads:
+            self._load_listeners.append(listener)
+
+    def slot(self, index):
+        """Returns the raw (state, chaddr, xid, expiry) of the slot."""
+        return (self._state[index], self._chaddr[index], self._xid[index],
+                self._expiry[index])
+
+    def load(self, index, state, chaddr, xid, expiry):
+        """Overwrites the slot, notifying only the 'loads' listeners."""
+        self._store(index, state, chaddr, xid, expiry)
+        for listener in self._load_listeners:
+            listener(index)
+
+    def _store(self, index, state, chaddr, xid, expiry):
+        owner = self._chaddr[index]
+        if owner != chaddr and self._owners.get(owner) == index:
+            del self._owners[owner]
+        if chaddr and state != self.RESERVED:
+            self._owners[chaddr] = index
+        self._chaddr[index] = chaddr
+        self._state[index] = state
+        self._xid[index] = xid
+        self._expiry[index] = expiry
+
+    def expire(self, now=None):
+        """Marks every expired slot as FREE and returns their number."""
+        now = self.now() if now is None else now
+        state = self._state
+        expiry = self._expiry
+        count = 0
+        for index in range(len(state)):
+            if state[index] != self.FREE and now > expiry[index]:
+                state[index] = self.FREE
+                count += 1
+        return count
+
+    def leases(self, now=None):
+        """Yields Lease records for every slot that has ever been used."""
+        now = self.now() if now is None else now
+        for index in range(len(self._state)):
+            if self._is_used(index):
+                yield self._record(index, now)
+
+    def snapshot(self):
+        """Returns an independent copy of the table."""
+        table = LeaseTable.__new__(LeaseTable)
+        table.clock = self.clock
+        table.start = self.start
+        table.end = self.end
+        table._base = self._base
+        table._state = array(self.STATE_TYPE, self._state)
+        table._chaddr = array(self.CHADDR_TYPE, self._chaddr)
+        table._xid = array(self.XID_TYPE, self._xid)
+        table._expiry = array(self.EXPIRY_TYPE, self._expiry)
+        table._listeners = []
+        table._load_listeners = []
+        table._owners = dict(self._owners)
+        table._cursors = {}
+        return table
+
+    def _is_used(self, index):
+        state = self._state[index]
+        if state == self.RESERVED:
+            return False
+        return state != self.FREE or self._chaddr[index] != 0
+
+    def _record(self, index, now):
+        return Lease(
+            self.address(index).exploded,
+            int_to_mac(self._chaddr[index]),
+            self.state(index, now),
+            self._xid[index],
+            self._expiry[index]
+        )
+
+    def _set(self, index, chaddr, state, xid, expiry):
+        self._store(index, state, chaddr, xid, expiry)
+        self._notify(index)
+
+    def _notify(self, index):
+        for listener in self._listeners:
+            listener(index)
+
+
+class ConcurrentLeaseTable(LeaseTable):
+    """LeaseTable safe for handlers running on many threads at once.
+
+    Writes take one of STRIPES locks chosen by slot index, so unrelated
+    slots never contend. Lookups (state, get, match, slot) read the arrays
+    without locking; every write re-validates the slot under its lock.
+    Offers additionally hold a lock striped by chaddr, so concurrent
+    DHCPDISCOVERs of one client cannot take two slots, and a slot is
+    claimed only after it is re-checked under its lock, so one address is
+    never offered to two clients.
+
+    A resize may run while other threads hold slot indexes taken before
+    it: writes by an index past the end of the table are ignored and
+    lookups report such a slot as free.
+
+    """
+
+    STRIPES = 64
+
+    def __init__(self, start, end, clock=time.monotonic, stripes=None):
+        super(ConcurrentLeaseTable, self).__init__(start, end, clock=clock)
+        self.stripes = stripes or self.STRIPES
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+        self._client_locks = [threading.Lock() for _ in range(self.stripes)]
+
+    def _lock(self, index):
+        return self._locks[index % self.stripes]
+
+    def _in_table(self, index):
+        return 0 <= index < len(self._state)
+
+    def state(self, index, now=None):
+        try:
+            return super(ConcurrentLeaseTable, self).state(index, now)
+        except IndexError:
+            return self.FREE
+
+    def get(self, ip, now=None):
+        try:
+            return super(ConcurrentLeaseTable, self).get(ip, now)
+        except IndexError:
+            return None
+
+    def match(self, index, chaddr, xid=None):
+        try:
+            return super(ConcurrentLeaseTable, self).match(index, chaddr, xid)
+        except IndexError:
+            return False
+
+    def slot(self, index):
+        try:
+            return super(ConcurrentLeaseTable, self).slot(index)
+        except IndexError:
+            return self.FREE, 0, 0, 0
+
+    def offer(self, chaddr, xid, timeout, now=None, share=None,
+              bounds=None):
+        with self._client_locks[chaddr % self.stripes]:
+            return super(ConcurrentLeaseTable, self).offer(
+                chaddr, xid, timeout, now=now, share=share, bounds=bounds
+            )
+
+    def _claim(self, index, chaddr, xid, timeout, now, part, parts):
+        with self._lock(index):
+            if not self._in_table(index) or \
+                    not self._available(index, chaddr, now, part, parts):
+                return False
+            return super(ConcurrentLeaseTable, self)._claim(
+                index, chaddr, xid, timeout, now, part, parts
+            )
+
+    def bind(self, index, chaddr, xid, lease_time, now=None):
+        with self._lock(index):
+            if not self._in_table(index):
+                return False
+            return super(ConcurrentLeaseTable, self).bind(
+                index, chaddr, xid, lease_time, now=now
+            )
+
+    def release(self, index, chaddr):
+        with self._lock(index):
+            if not self._in_table(index):
+                return False
+            return super(ConcurrentLeaseTable, self).release(index, chaddr)
+
+    def decline(self, index, chaddr):
+        with self._lock(index):
+            if not self._in_table(index):
+                return False
+            return super(ConcurrentLeaseTable, self).decline(index, chaddr)
+
+    def reserve(self, index):
+        with self._lock(index):
+            if self._in_table(index):
+                super(ConcurrentLeaseTable, self).reserve(index)
+
+    def unreserve(self, index):
+        with self._lock(index):
+            if self._in_table(index):
+                super(ConcurrentLeaseTable, self).unreserve(index)
+
+    def resize(self, start, end, now=None):
+        """Resizes the table holding every lock.
+
+        Writers are blocked for the duration of the in-place array moves
+        and re-check their index once they get the lock. An index taken
+        before a resize that moved 'start' may name another address: the
+        writes that check the chaddr (bind, release, decline) then fail
+        and the client retries, but an offer may be answered with an
+        address other than the one claimed, which its DHCPREQUEST cannot
+        bind. Lock-free lookups racing a resize may read a stale slot.
+
+        """
+        locks = self._client_locks + self._locks
+        for lock in locks:
+            lock.acquire()
+        try:
+            return super(ConcurrentLeaseTable, self).resize(start, end,
+                                                            now=now)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def snapshot(self):
+        """Copies the table while holding every slot lock."""
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            return super(ConcurrentLeaseTable, self).snapshot()
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+
+    def load(self, index, state, chaddr, xid, expiry):
+        with self._lock(index):
+            if self._in_table(index):
+                super(ConcurrentLeaseTable, self).load(index, state, chaddr,
+                                                       xid, expiry)
+
+    def expire(self, now=None):
+        now = self.now() if now is None else now
+        count = 0
+        for index in range(len(self._state)):
+            try:
+                if self._state[index] == self.FREE or \
+                        now <= self._expiry[index]:
+                    continue
+            except IndexError:
+                break
+            with self._lock(index):
+                if self._in_table(index) and \
+                        self._state[index] != self.FREE and \
+                        now > self._expiry[index]:
+                    self._state[index] = self.FREE
+                    count += 1
+        return count
@@ -0,0 +1,271 @@
+"""Lease queries, RFC 4388 DHCPLEASEQUERY and streaming lease export.
+
+LeaseIndex keeps secondary indexes over the lease table of a DHCPServer:
+by MAC (maintained from the table change and load notifications, so
+bindings learned from a replication peer are included) and by client
+identifier (option 61) and relay agent remote-id (option 82), recorded
+when a binding is acknowledged. Lookups by IP use the table directly.
+
+The export works on a snapshot (a copy of the table arrays and of the
+identifier annotations) and yields it in chunks, so a large table can be
+written out without blocking the packet handler.
+
+"""
+import csv
+import io
+import json
+import time
+import threading
+
+from .lease import LeaseTable, int_to_mac, mac_to_int
+from .policy import find_option, agent_info
+from .message import DHCPMessage
+from .options import DHCPOption53, DHCPOption51, DHCPOption54
+
+
+CLIENT_ID_OPTION = 61
+
+EXPORT_FIELDS = ('ip', 'chaddr', 'state', 'remaining', 'expires',
+                 'client_id', 'remote_id')
+STATE_NAMES = {
+    LeaseTable.FREE: 'free',
+    LeaseTable.ACTIVE: 'active',
+    LeaseTable.OFFERED: 'offered',
+}
+
+
+class LeaseIndex(object):
+    """Secondary indexes over the lease table of a DHCPServer."""
+
+    def __init__(self, server):
+        self.server = server
+        self.table = server.leases
+        self._by_mac = {}
+        self._by_client_id = {}
+        self._by_remote_id = {}
+        # Slot index -> (chaddr, client_id, remote_id) currently indexed.
+        self._slots = {}
+        self._lock = threading.Lock()
+        self.rebuild()
+        self.table.subscribe(self._on_change, loads=True)
+        server.lease_index = self
+
+    def rebuild(self):
+        """Reindexes the whole table, required after LeaseTable.resize.
+
+        Client-id and remote-id annotations of bindings that stayed in the
+        pool are carried over to their new slots.
+
+        """
+        with self._lock:
+            annotations = {
+                chaddr: (client_id, remote_id)
+                for chaddr, client_id, remote_id in self._slots.values()
+            }
+            self._by_mac = {}
+            self._by_client_id = {}
+            self._by_remote_id = {}
+            self._slots = {}
+            for index in range(len(self.table)):
+                state, chaddr, _, _ = self.table.slot(index)
+                if state == LeaseTable.RESERVED or not chaddr:
+                    continue
+                client_id, remote_id = annotations.get(chaddr, (None, None))
+                self._slots[index] = (chaddr, client_id, remote_id)
+                self._by_mac[chaddr] = index
+                if client_id is not None:
+                    self._by_client_id[client_id] = index
+                if remote_id is not None:
+                    self._by_remote_id.setdefault(remote_id, set()).add(index)
+
+    def _on_change(self, index):
+        state, chaddr, _, _ = self.table.slot(index)
+        old_chaddr, client_id, remote_id = self._slots.get(
+            index, (0, None, None)
+        )
+        if old_chaddr == chaddr:
+            return
+        with self._lock:
+            self._unindex(index)
+            if state == LeaseTable.RESERVED or not chaddr:
+                return
+            self._slots[index] = (chaddr, None, None)
+            self._by_mac[chaddr] = index
+
+    def _unindex(self, index):
+        chaddr, client_id, remote_id = self._slots.pop(index, (0, None, None))
+        if self._by_mac.get(chaddr) == index:
+            del self._by_mac[chaddr]
+        if client_id is not None and \
+                self._by_client_id.get(client_id) == index:
+            del self._by_client_id[client_id]
+        if remote_id is not None:
+            slots = self._by_remote_id.get(remote_id)
+            if slots:
+                slots.discard(index)
+                if not slots:
+                    del self._by_remote_id[remote_id]
+
+    def annotate(self, ip, payload):
+        """Records client-id and remote-id of the message bound to 'ip'."""
+        index = self.table.index(ip)
+        if index is None:
+            return
+        chaddr = self.table.slot(index)[1]
+        if not chaddr:
+            return
+        client_id = find_option(payload, CLIENT_ID_OPTION)
+        remote_id = agent_info(payload)[1]
+        with self._lock:
+            self._unindex(index)
+            self._slots[index] = (chaddr, client_id, remote_id)
+            self._by_mac[chaddr] = index
+            if client_id is not None:
+                self._by_client_id[client_id] = index
+            if remote_id is not None:
+                self._by_remote_id.setdefault(remote_id, set()).add(index)
+
+    def by_ip(self, ip):
+        """Returns the Lease of an address or None."""
+        return self.table.get(ip, now=self.server._now())
+
+    def by_mac(self, chaddr):
+        """Returns the Lease of a 'AA:BB:CC:DD:EE:FF' MAC or None."""
+        return self._record(self._by_mac.get(mac_to_int(chaddr)))
+
+    def by_client_id(self, client_id):
+        """Returns the Lease of a raw (bytes) client identifier or None."""
+        return self._record(self._by_client_id.get(client_id))
+
+    def by_remote_id(self, remote_id):
+        """Returns the list of Leases of a raw (bytes) remote-id."""
+        return [self._record(index) for index in
+                sorted(self._by_remote_id.get(remote_id, ()))]
+
+    def annotations(self):
+        """Returns a copy of slot index -> (chaddr, client_id, remote_id)."""
+        with self._lock:
+            return dict(self._slots)
+
+    def _record(self, index):
+        if index is None:
+            return None
+        return self.table.get(self.table.address(index),
+                              now=self.server._now())
+
+    def leasequery(self, message):
+        """Builds the RFC 4388 reply to a DHCPLEASEQUERY message.
+
+        The query is by ciaddr, by chaddr or by client identifier, in that
+        order of precedence.
+
+        """
+        lease = None
+        known = False
+        if message.ciaddr != '0.0.0.0':
+            known = self.table.index(message.ciaddr) is not None
+            lease = self.by_ip(message.ciaddr) if known else None
+        elif message.hlen and mac_to_int(message.chaddr or '0'):
+            lease = self.by_mac(message.chaddr)
+        elif message.option61:
+            lease = self.by_client_id(bytes.fromhex(message.option61.value))
+
+        now = self.server._now()
+        if lease and lease.state == LeaseTable.ACTIVE:
+            return DHCPMessage.from_message(
+                message,
+                op=DHCPMessage.BOOTREPLY,
+                ciaddr=lease.ip,
+                chaddr=lease.chaddr,
+                options=(
+                    DHCPOption53(DHCPOption53.DHCPLEASEACTIVE),
+                    DHCPOption51(max(lease.end_time - now, 0)),
+                    DHCPOption54(self.server.config.identifier.exploded)
+                )
+            )
+        message_type = DHCPOption53.DHCPLEASEUNKNOWN
+        if known or lease:
+            message_type = DHCPOption53.DHCPLEASEUNASSIGNED
+        return DHCPMessage.from_message(
+            message,
+            op=DHCPMessage.BOOTREPLY,
+            options=(DHCPOption53(message_type),
+                     DHCPOption54(self.server.config.identifier.exploded))
+        )
+
+
+def iter_export(server, fmt='jsonl', chunk_size=1024):
+    """Yields the lease table of a DHCPServer as JSON lines or CSV chunks.
+
+    The table is copied first (one memcpy per array, under the slot locks
+    of a ConcurrentLeaseTable), so the chunks describe one consistent
+    state however long the consumer takes. Expiry is exported as seconds
+    remaining and as Unix time, both taken from the server clock when the
+    copy is made; free slots have neither.
+
+    :param server: DHCPServer instance, its LeaseIndex (if any) adds the
+        client-id and remote-id columns
+    :param fmt: 'jsonl' or 'csv'
+    :param chunk_size: leases per yielded chunk
+
+    """
+    if fmt not in ('jsonl', 'csv'):
+        raise ValueError('Unknown export format {}'.format(fmt))
+    snapshot = server.leases.snapshot()
+    now = server._now()
+    wall_now = int(time.time())
+    lease_index = server.lease_index
+    annotations = lease_index.annotations() if lease_index else {}
+
+    if fmt == 'csv':
+        yield ','.join(EXPORT_FIELDS) + '\r\n'
+    rows = []
+    for index in range(len(snapshot)):
+        state, chaddr, _, expiry = snapshot.slot(index)
+        if state == LeaseTable.RESERVED or (state == LeaseTable.FREE and
+                                            not chaddr):
+            continue
+        owner, client_id, remote_id = annotations.get(index, (0, None, None))
+        if owner != chaddr:
+            client_id = remote_id = None
+        state = snapshot.state(index, now)
+        remaining = expires = None
+        if state != LeaseTable.FREE:
+            remaining = expiry - now
+            expires = wall_now + remaining
+        rows.append((
+            snapshot.address(index).exploded,
+            int_to_mac(chaddr),
+            STATE_NAMES[state],
+            remaining,
+            expires,
+            client_id.hex() if client_id is not None else None,
+            remote_id.hex() if remote_id is not None else None,
+        ))
+        if len(rows) == chunk_size:
+            yield _format_rows(rows, fmt)
+            rows = []
+    if rows:
+        yield _format_rows(rows, fmt)
+
+
+def _format_rows(rows, fmt):
+    if fmt == 'jsonl':
+        return ''.join(
+            json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n' for row in rows
+        )
+    output = io.StringIO()
+    csv.writer(output).writerows(rows)
+    return output.getvalue()
+
+
+def export_leases(server, stream, fmt='jsonl', chunk_size=1024):
+    """Writes the lease table of a DHCPServer to a text stream.
+
+    Between chunks the thread yields, so when the export runs in its own
+    thread the packet handler keeps being scheduled.
+
+    """
+    for chunk in iter_export(server, fmt, chunk_size):
+        stream.write(chunk)
+        time.sleep(0)
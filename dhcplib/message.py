@@ -98,13 +98,15 @@ class DHCPMessage(object):
 
     @classmethod
     def from_message(cls, message, **kwargs):
-        message.__dict__.update(kwargs)
-        return cls(**message.__dict__)
+        fields = dict(message.__dict__)
+        fields['options'] = tuple(fields.pop('_options').values())
+        fields.update(kwargs)
+        return cls(**fields)
 
     @classmethod
     def from_bytes(cls, bytes_stream):
         op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, \
-        giaddr, chaddr, sname, file, _ = struct.unpack(
+        giaddr, chaddr, sname, file, *_ = struct.unpack(
             cls.HEADER_FORMAT,
             bytes_stream[:cls.HEADER_LEN]
         )
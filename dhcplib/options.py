@@ -6,7 +6,7 @@ import binascii
 __all__ = (
     'DHCPOption', 'DHCPOption1', 'DHCPOption3', 'DHCPOption6', 'DHCPOption12',
     'DHCPOption15', 'DHCPOption50', 'DHCPOption51', 'DHCPOption53',
-    'DHCPOption54', 'DHCPOption82'
+    'DHCPOption54', 'DHCPOption61', 'DHCPOption82'
 )
 
 
@@ -55,14 +55,34 @@ class DHCPOption(object):
         return instance
 
 
+class PackedOption(DHCPOption):
+    """Option encoded once, its pack() returns the cached bytes."""
+
+    def __init__(self, option):
+        super(PackedOption, self).__init__(option.value)
+        self.code = option.code
+        self._packed = option.pack()
+        self.length = option.length
+
+    def __str__(self):
+        return '{}(CODE: {} LENGTH: {} VALUE: {})'.format(
+            self.__class__.__name__, self.code, self.length, self.value
+        )
+
+    def pack(self):
+        return self._packed
+
+
 class _DHCPOptionIP(DHCPOption):
 
     MIN_VALUE_LEN = 4
 
     def pack(self):
         if any(isinstance(self.value, cls_type) for cls_type in (tuple, list)):
-            for value in self.value:
-                self._payload += socket.inet_aton(str(value))
+            self._payload = b''.join(
+                socket.inet_aton(str(value)) for value in self.value
+            )
+            self.length = len(self._payload)
         else:
             self.length = self.MIN_VALUE_LEN
             self._payload = socket.inet_aton(str(self.value))
@@ -157,10 +177,16 @@ class DHCPOption53(_DHCPOptionInt):
     DHCPNAK = 6
     DHCPRELEASE = 7
     DHCPINFORM = 8
+    # RFC 4388 leasequery.
+    DHCPLEASEQUERY = 10
+    DHCPLEASEUNASSIGNED = 11
+    DHCPLEASEUNKNOWN = 12
+    DHCPLEASEACTIVE = 13
 
     MESSAGE_TYPES = (
         DHCPDISCOVER, DHCPOFFER, DHCPREQUEST, DHCPDECLINE, DHCPACK, DHCPNAK,
-        DHCPRELEASE, DHCPINFORM
+        DHCPRELEASE, DHCPINFORM, DHCPLEASEQUERY, DHCPLEASEUNASSIGNED,
+        DHCPLEASEUNKNOWN, DHCPLEASEACTIVE
     )
 
     code = 53
@@ -179,6 +205,22 @@ class DHCPOption54(_DHCPOptionIP):
     length = 4
 
 
+class DHCPOption61(DHCPOption):
+    """Client identifier, the value is a hex string."""
+
+    code = 61
+
+    def pack(self):
+        self._payload = binascii.a2b_hex(self.value)
+        return super(DHCPOption61, self).pack()
+
+    @classmethod
+    def from_bytes(cls, bytes_stream):
+        instance = super(DHCPOption61, cls).from_bytes(bytes_stream)
+        instance.value = binascii.b2a_hex(instance._payload).decode('ascii')
+        return instance
+
+
 class _DHCPSubOption82CircuitId(DHCPOption):
 
     code = 1
@@ -240,10 +282,14 @@ class DHCPOption82(DHCPOption):
 
     def __init__(self, circuit_id=None, remote_id=None):
         super(DHCPOption82, self).__init__()
-        self.circuit_id = self._get_option_instance(_DHCPSubOption82CircuitId,
-                                                    circuit_id)
-        self.remote_id = self._get_option_instance(_DHCPSubOption82RemoteId,
-                                                   remote_id)
+        self._circuit_id = self._get_option_instance(
+            _DHCPSubOption82CircuitId, circuit_id
+        )
+        self._remote_id = self._get_option_instance(_DHCPSubOption82RemoteId,
+                                                    remote_id)
+        self._decoded = True
+        # Whether _payload holds the encoded sub-options.
+        self._encoded = False
 
     def __str__(self):
         return '{}(LENGTH: {}, VALUE: {})'.format(
@@ -252,6 +298,31 @@ class DHCPOption82(DHCPOption):
             (self.circuit_id, self.remote_id)
         )
 
+    @property
+    def circuit_id(self):
+        self._decode()
+        return self._circuit_id
+
+    @circuit_id.setter
+    def circuit_id(self, value):
+        self._decode()
+        self._encoded = False
+        self._circuit_id = self._get_option_instance(
+            _DHCPSubOption82CircuitId, value
+        )
+
+    @property
+    def remote_id(self):
+        self._decode()
+        return self._remote_id
+
+    @remote_id.setter
+    def remote_id(self, value):
+        self._decode()
+        self._encoded = False
+        self._remote_id = self._get_option_instance(_DHCPSubOption82RemoteId,
+                                                    value)
+
     @staticmethod
     def _get_option_instance(option_cls, value):
         if not value:
@@ -259,29 +330,45 @@ class DHCPOption82(DHCPOption):
         return value if isinstance(value, option_cls) else option_cls(value)
 
     def pack(self):
-        self._payload = self.circuit_id.pack(self.encode_ascii) + \
-                        self.remote_id.pack(self.encode_ascii)
+        """A received option is packed verbatim (RFC 3046 echo), including
+        sub-options this class does not know."""
+        if not self._encoded:
+            self._payload = b''.join(
+                sub_option.pack(self.encode_ascii)
+                for sub_option in (self.circuit_id, self.remote_id)
+                if sub_option
+            )
+            self.length = len(self._payload)
+            self._encoded = True
         return super(DHCPOption82, self).pack()
 
     @classmethod
     def from_bytes(cls, bytes_stream):
+        """Sub-options are decoded on first access of circuit/remote id."""
         instance = super(DHCPOption82, cls).from_bytes(bytes_stream)
+        instance._decoded = False
+        instance._encoded = True
+        return instance
+
+    def _decode(self):
+        if self._decoded:
+            return
+        self._decoded = True
         index = 0
-        for _ in range(len(cls.SUB_OPTIONS)):
-            payload_start_index = index + cls.HEADER_LEN
+        while index + self.HEADER_LEN <= len(self._payload):
+            payload_start_index = index + self.HEADER_LEN
             sub_option_code, sub_option_length = struct.unpack(
-                '!BB', instance._payload[index:payload_start_index]
+                '!BB', self._payload[index:payload_start_index]
             )
-            sub_option_class = cls.SUB_OPTIONS.get(sub_option_code)
+            sub_option_class = self.SUB_OPTIONS.get(sub_option_code)
             if sub_option_class:
                 sub_option = sub_option_class.from_bytes(
-                    instance._payload[index:
-                                      payload_start_index + sub_option_length],
-                    encode_ascii=cls.encode_ascii
+                    self._payload[index:
+                                  payload_start_index + sub_option_length],
+                    encode_ascii=self.encode_ascii
                 )
                 if sub_option.code == _DHCPSubOption82CircuitId.code:
-                    instance.circuit_id = sub_option
+                    self._circuit_id = sub_option
                 elif sub_option.code == _DHCPSubOption82RemoteId.code:
-                    instance.remote_id = sub_option
+                    self._remote_id = sub_option
             index = payload_start_index + sub_option_length
-        return instance
@@ -0,0 +1,312 @@
+"""Linux AF_PACKET transport for DHCPServer.
+
+A packet socket per interface receives whole Ethernet frames. A classic
+BPF program attached to the socket lets only IPv4/UDP datagrams to the
+server port reach user space, and an optional PACKET_MMAP receive ring
+avoids one system call and one copy per frame. Replies are built as
+complete Ethernet/IPv4/UDP frames, so a client can be addressed by its
+hardware address before it has an IP address.
+
+Usage:
+
+    transport = functools.partial(PacketServer, ifaces=('eth0',))
+    server = DHCPServer(config, transport=transport)
+
+"""
+import mmap
+import ctypes
+import select
+import socket
+import struct
+
+from .udp import BROADCAST
+from .utils import get_ip_by_iface
+
+
+ETH_P_IP = 0x0800
+ETH_HEADER = struct.Struct('!6s6sH')
+IP_HEADER = struct.Struct('!BBHHHBBH4s4s')
+UDP_HEADER = struct.Struct('!HHHH')
+BROADCAST_MAC = b'\xff' * 6
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_IGNORE_OUTGOING = 23
+PACKET_OUTGOING = 4
+SO_ATTACH_FILTER = 26
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+BOOTREQUEST = 1
+
+# TPACKET_V1 ring frame header: tp_status, tp_len, tp_snaplen, tp_mac,
+# tp_net, tp_sec, tp_usec.
+TPACKET_HDR = struct.Struct('LIIHHII')
+# sll_pkttype of the sockaddr_ll following the header (TPACKET_ALIGN).
+TPACKET_PKTTYPE = (TPACKET_HDR.size + 15) // 16 * 16 + 10
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# Classic BPF opcodes.
+BPF_LDH_ABS = 0x28
+BPF_LDB_ABS = 0x30
+BPF_LDH_IND = 0x48
+BPF_LDB_IND = 0x50
+BPF_LDXB_MSH = 0xb1
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+BPF_INSN = struct.Struct('HBBI')
+
+
+def dhcp_filter(port):
+    """Returns the classic BPF program accepting DHCP requests to 'port'.
+
+    Equivalent to tcpdump 'ip and udp dst port <port> and udp[8] == 1' for
+    unfragmented datagrams: BOOTREPLYs of other servers and relays are
+    dropped in the kernel.
+
+    """
+    return (
+        (BPF_LDH_ABS, 0, 0, 12),        # ethertype
+        (BPF_JEQ_K, 0, 10, ETH_P_IP),
+        (BPF_LDB_ABS, 0, 0, 23),        # IP protocol
+        (BPF_JEQ_K, 0, 8, socket.IPPROTO_UDP),
+        (BPF_LDH_ABS, 0, 0, 20),        # fragment offset
+        (BPF_JSET_K, 6, 0, 0x1fff),
+        (BPF_LDXB_MSH, 0, 0, 14),       # x = IP header length
+        (BPF_LDH_IND, 0, 0, 16),        # UDP destination port
+        (BPF_JEQ_K, 0, 3, port),
+        (BPF_LDB_IND, 0, 0, 22),        # BOOTP op
+        (BPF_JEQ_K, 0, 1, BOOTREQUEST),
+        (BPF_RET_K, 0, 0, 0x40000),
+        (BPF_RET_K, 0, 0, 0),
+    )
+
+
+def attach_filter(sock, program):
+    code = b''.join(BPF_INSN.pack(*insn) for insn in program)
+    buffer = ctypes.create_string_buffer(code)
+    fprog = struct.pack('HL', len(program), ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def ip_checksum(header):
+    total = sum(struct.unpack('!{}H'.format(len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def build_frame(payload, src_mac, dst_mac, src_ip, dst_ip, src_port,
+                dst_port):
+    """Returns an Ethernet frame carrying 'payload' in IPv4/UDP.
+
+    The UDP checksum is left zero, which IPv4 allows.
+
+    """
+    udp = UDP_HEADER.pack(src_port, dst_port, UDP_HEADER.size + len(payload),
+                          0)
+    total_len = IP_HEADER.size + len(udp) + len(payload)
+    header = IP_HEADER.pack(0x45, 0x10, total_len, 0, 0, 64,
+                            socket.IPPROTO_UDP, 0, src_ip, dst_ip)
+    header = header[:10] + struct.pack('!H', ip_checksum(header)) + \
+        header[12:]
+    return ETH_HEADER.pack(dst_mac, src_mac, ETH_P_IP) + header + udp + \
+        payload
+
+
+def parse_frame(frame):
+    """Returns (payload, (src_ip, src_port)) of an Ethernet IPv4/UDP frame.
+
+    Returns None if the frame is not a complete IPv4/UDP datagram.
+
+    """
+    offset = ETH_HEADER.size
+    if len(frame) < offset + IP_HEADER.size + UDP_HEADER.size:
+        return None
+    version_ihl = frame[offset]
+    if version_ihl >> 4 != 4:
+        return None
+    src_ip = socket.inet_ntoa(bytes(frame[offset + 12:offset + 16]))
+    udp = offset + (version_ihl & 0x0f) * 4
+    if len(frame) < udp + UDP_HEADER.size:
+        return None
+    src_port, _, length, _ = UDP_HEADER.unpack_from(frame, udp)
+    end = min(len(frame), udp + length)
+    return bytes(frame[udp + UDP_HEADER.size:end]), (src_ip, src_port)
+
+
+# Program dropping every datagram, for sockets that only send.
+DROP_ALL_FILTER = ((BPF_RET_K, 0, 0, 0),)
+
+
+class _PacketSocket(object):
+    """Packet socket bound to one interface, with an optional RX ring.
+
+    Each interface also gets a send-only UDP socket for replies to relay
+    agents and configured clients; it is bound to the interface and its
+    address only (not to the wildcard address), and its filter drops
+    everything, so the kernel queues nothing on it and other port 67
+    listeners on the host are not affected.
+
+    """
+
+    FRAME_SIZE = 2048
+    BLOCK_SIZE = 1 << 16
+
+    def __init__(self, iface, port, ring_blocks=0):
+        self.iface = iface
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                  socket.htons(ETH_P_IP))
+        attach_filter(self.sock, dhcp_filter(port))
+        try:
+            # Our own replies to giaddr:67 would pass the filter.
+            self.sock.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+        except OSError:
+            pass  # Linux < 4.20, the packet type is checked on receive.
+        self.sock.bind((iface, ETH_P_IP))
+        self.mac = self.sock.getsockname()[4]
+        self.ip = socket.inet_aton(get_ip_by_iface(iface))
+
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                 socket.IPPROTO_UDP)
+        attach_filter(self.udp, DROP_ALL_FILTER)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE,
+                            iface.encode())
+        self.udp.bind((socket.inet_ntoa(self.ip), port))
+        self._ring = None
+        self._frame = 0
+        self._frame_nr = 0
+        if ring_blocks:
+            self._frame_nr = ring_blocks * self.BLOCK_SIZE // self.FRAME_SIZE
+            self.sock.setsockopt(
+                SOL_PACKET, PACKET_RX_RING,
+                struct.pack('IIII', self.BLOCK_SIZE, ring_blocks,
+                            self.FRAME_SIZE, self._frame_nr)
+            )
+            self._ring = mmap.mmap(self.sock.fileno(),
+                                   ring_blocks * self.BLOCK_SIZE)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def ready(self):
+        """Checks whether a frame can be read without blocking."""
+        if self._ring is None:
+            return False
+        status = TPACKET_HDR.unpack_from(
+            self._ring, self._frame * self.FRAME_SIZE
+        )[0]
+        return bool(status & TP_STATUS_USER)
+
+    def receive(self):
+        """Returns a frame, parsed when read from the ring, or None."""
+        if self._ring is None:
+            frame, address = self.sock.recvfrom(self.FRAME_SIZE)
+            return None if address[2] == PACKET_OUTGOING else frame
+        offset = self._frame * self.FRAME_SIZE
+        status, _, snaplen, mac, _, _, _ = TPACKET_HDR.unpack_from(
+            self._ring, offset
+        )
+        if not status & TP_STATUS_USER:
+            return None
+        data = None
+        if self._ring[offset + TPACKET_PKTTYPE] != PACKET_OUTGOING:
+            view = memoryview(self._ring)
+            try:
+                data = parse_frame(view[offset + mac:offset + mac + snaplen])
+            finally:
+                view.release()
+        struct.pack_into('L', self._ring, offset, TP_STATUS_KERNEL)
+        self._frame = (self._frame + 1) % self._frame_nr
+        return data
+
+    def close(self):
+        if self._ring is not None:
+            self._ring.close()
+        self.sock.close()
+        self.udp.close()
+
+
+class PacketServer(object):
+    """AF_PACKET counterpart of UDPServer, bound to specific interfaces.
+
+    Replies to IP-addressable destinations (relay agents, ciaddr) go
+    through the UDP socket of the receiving interface so that the kernel
+    resolves the next hop; replies
+    to clients without an address are sent as raw frames to chaddr or to
+    the Ethernet broadcast address.
+
+    """
+
+    UNICAST_TO_CHADDR = True
+
+    def __init__(self, listen_port, proto_handler, ifaces, timeout=None,
+                 ring_blocks=0, source_ip=None):
+        """PacketServer initial.
+
+        :param ifaces: iterable object contains interface names
+        :param ring_blocks: number of 64 KiB PACKET_MMAP ring blocks per
+            interface, 0 to receive with recv()
+        :param source_ip: IP address written into raw replies, defaults to
+            the address of the receiving interface
+
+        """
+        self._listen_port = listen_port
+        self._proto_handler = proto_handler
+        self._timeout = timeout
+        self._sockets = [_PacketSocket(iface, listen_port, ring_blocks)
+                         for iface in ifaces]
+        self._source_ip = socket.inet_aton(source_ip) if source_ip else None
+        self._last = self._sockets[0]
+
+    def send_data(self, data, port, addr=BROADCAST, chaddr=None):
+        packet_sock = self._last
+        if addr != BROADCAST and not chaddr:
+            packet_sock.udp.sendto(data, (addr, port))
+            return
+        if addr == BROADCAST:
+            dst_ip = b'\xff' * 4
+            dst_mac = BROADCAST_MAC
+        else:
+            dst_ip = socket.inet_aton(addr)
+            dst_mac = bytes.fromhex(chaddr.replace(':', ''))
+        packet_sock.sock.send(build_frame(
+            data, packet_sock.mac, dst_mac,
+            self._source_ip or packet_sock.ip, dst_ip,
+            self._listen_port, port
+        ))
+
+    def received_data(self):
+        while True:
+            for packet_sock in self._sockets:
+                if packet_sock.ready():
+                    data = self._receive(packet_sock)
+                    if data:
+                        return data
+            readable, _, _ = select.select(self._sockets, [], [],
+                                           self._timeout)
+            if not readable:
+                raise socket.timeout('timed out')
+            for packet_sock in readable:
+                data = self._receive(packet_sock)
+                if data:
+                    return data
+
+    def _receive(self, packet_sock):
+        data = packet_sock.receive()
+        if data is None:
+            return None
+        if not isinstance(data, tuple):
+            data = parse_frame(data)
+        if data:
+            self._last = packet_sock
+        return data
+
+    def stop(self):
+        for packet_sock in self._sockets:
+            packet_sock.close()
+
+    def start_handle(self):
+        while True:
+            self._proto_handler(self.received_data())
@@ -0,0 +1,472 @@
+"""Offline bulk decoding of captured DHCP traffic.
+
+'iter_frames' walks the records of a pcap or pcapng file; 'decode_pcap'
+turns every DHCP packet of the file into one row of a NumPy structured
+array. The second step is vectorized: the Ethernet/IPv4/UDP headers and
+the fixed BOOTP header are gathered for all packets at once, and the
+options area is walked by advancing one cursor per packet in lock step, so
+the per-packet Python cost is only the record header walk.
+
+That walk is the limit: record offsets depend on the previous record's
+length, so they are found one record at a time in Python. A pcap decodes
+at roughly 400k packets per second, pcapng somewhat slower; millions of
+packets per second would need the walk in C.
+
+NumPy is required by 'decode_pcap' only.
+
+"""
+import os
+import mmap
+import traceback
+import socket
+import struct
+from array import array
+from contextlib import contextmanager
+
+from .error import PcapFormatError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Link types.
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_IPV4 = 228
+
+LINK_HEADER_LEN = {
+    LINKTYPE_ETHERNET: 14,
+    LINKTYPE_RAW: 0,
+    LINKTYPE_IPV4: 0,
+}
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_HEADER_LEN = 24
+PCAP_RECORD_LEN = 16
+
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_OPT_TSRESOL = 9
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+IPPROTO_UDP = 17
+DHCP_PORTS = (67, 68)
+BOOTP_LEN = 240
+MAGIC_COOKIE = 0x63825363
+END_OPTION = 255
+PAD_OPTION = 0
+
+# Bits of the 'present' column.
+HAS_OPTION50 = 1
+HAS_OPTION51 = 2
+HAS_OPTION54 = 4
+HAS_OPTION82 = 8
+
+RECORD_FIELDS = (
+    ('frame', 'u4'), ('time', 'f8'),
+    ('src_ip', 'u4'), ('dst_ip', 'u4'),
+    ('src_port', 'u2'), ('dst_port', 'u2'),
+    ('op', 'u1'), ('htype', 'u1'), ('hlen', 'u1'), ('hops', 'u1'),
+    ('xid', 'u4'), ('secs', 'u2'), ('flags', 'u2'),
+    ('ciaddr', 'u4'), ('yiaddr', 'u4'), ('siaddr', 'u4'), ('giaddr', 'u4'),
+    ('chaddr', 'u8'),
+    ('present', 'u1'),
+    ('option53', 'u1'), ('option50', 'u4'), ('option51', 'u4'),
+    ('option54', 'u4'),
+    ('option82_offset', 'u8'), ('option82_len', 'u1'),
+)
+
+# Leading part of the BOOTP header, up to the end of 'chaddr'.
+_BOOTP_FIELDS = (
+    ('op', 'u1'), ('htype', 'u1'), ('hlen', 'u1'), ('hops', 'u1'),
+    ('xid', '>u4'), ('secs', '>u2'), ('flags', '>u2'),
+    ('ciaddr', '>u4'), ('yiaddr', '>u4'), ('siaddr', '>u4'),
+    ('giaddr', '>u4'), ('chaddr', 'u1', (16,)),
+)
+_BOOTP_FIELDS_LEN = 44
+
+# Options to extract: code -> (column, presence bit, value length).
+_OPTION_COLUMNS = {
+    53: ('option53', 0, 1),
+    50: ('option50', HAS_OPTION50, 4),
+    51: ('option51', HAS_OPTION51, 4),
+    54: ('option54', HAS_OPTION54, 4),
+}
+
+
+@contextmanager
+def open_capture(path):
+    """Memory-maps a capture file for reading."""
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < 4:
+            raise PcapFormatError('File is too short')
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buffer
+        finally:
+            buffer.close()
+
+
+def iter_frames(buffer):
+    """Yields (timestamp, linktype, offset, caplen) for every captured frame.
+
+    :param buffer: bytes-like object holding a pcap or pcapng file
+
+    """
+    if len(buffer) < 4:
+        raise PcapFormatError('File is too short')
+    if struct.unpack_from('<I', buffer)[0] == PCAPNG_SHB:
+        return _iter_pcapng_frames(buffer)
+    return _iter_pcap_frames(buffer)
+
+
+def _pcap_header(buffer):
+    """Returns byte order, timestamp resolution and link type of a pcap."""
+    for order in ('<', '>'):
+        magic = struct.unpack_from(order + 'I', buffer)[0]
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            break
+    else:
+        raise PcapFormatError('Unknown capture file format')
+    if len(buffer) < PCAP_HEADER_LEN:
+        raise PcapFormatError('File is too short')
+    resolution = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+    linktype = struct.unpack_from(order + 'I', buffer, 20)[0] & 0xffff
+    return order, resolution, linktype
+
+
+def _iter_pcap_frames(buffer):
+    order, resolution, linktype = _pcap_header(buffer)
+    record = struct.Struct(order + 'IIII')
+    offset = PCAP_HEADER_LEN
+    size = len(buffer)
+    while offset + PCAP_RECORD_LEN <= size:
+        ts_sec, ts_frac, caplen, _ = record.unpack_from(buffer, offset)
+        offset += PCAP_RECORD_LEN
+        if offset + caplen > size:
+            break
+        yield ts_sec + ts_frac * resolution, linktype, offset, caplen
+        offset += caplen
+
+
+def _iter_pcapng_frames(buffer):
+    order = '<'
+    interfaces = []
+    offset = 0
+    size = len(buffer)
+    while offset + 12 <= size:
+        block_type, block_len = struct.unpack_from(order + 'II', buffer,
+                                                   offset)
+        if block_type == PCAPNG_SHB:
+            magic = struct.unpack_from('<I', buffer, offset + 8)[0]
+            order = '<' if magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            block_len = struct.unpack_from(order + 'I', buffer, offset + 4)[0]
+            interfaces = []
+        if block_len < 12 or offset + block_len > size:
+            break
+        if block_type == PCAPNG_IDB:
+            linktype = struct.unpack_from(order + 'H', buffer, offset + 8)[0]
+            interfaces.append(
+                (linktype, _pcapng_resolution(buffer, order, offset,
+                                              block_len))
+            )
+        elif block_type == PCAPNG_EPB:
+            iface, ts_high, ts_low, caplen = struct.unpack_from(
+                order + 'IIII', buffer, offset + 8
+            )
+            if iface >= len(interfaces):
+                raise PcapFormatError(
+                    'Packet of undescribed interface {}'.format(iface)
+                )
+            linktype, resolution = interfaces[iface]
+            yield (((ts_high << 32) | ts_low) * resolution, linktype,
+                   offset + 28, caplen)
+        elif block_type == PCAPNG_SPB and interfaces:
+            origlen = struct.unpack_from(order + 'I', buffer, offset + 8)[0]
+            linktype, _ = interfaces[0]
+            yield 0.0, linktype, offset + 12, min(origlen, block_len - 16)
+        offset += block_len
+
+
+def _pcapng_resolution(buffer, order, offset, block_len):
+    index = offset + 16
+    end = offset + block_len - 4
+    while index + 4 <= end:
+        code, length = struct.unpack_from(order + 'HH', buffer, index)
+        if code == 0:
+            break
+        if code == PCAPNG_OPT_TSRESOL and length >= 1:
+            value = buffer[index + 4]
+            if value & 0x80:
+                return 2.0 ** -(value & 0x7f)
+            return 10.0 ** -value
+        index += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def iter_udp_payloads(buffer):
+    """Yields (timestamp, src, dst, payload) for every IPv4/UDP datagram.
+
+    'src' and 'dst' are (ip, port) tuples, 'payload' is a bytes copy.
+
+    """
+    for timestamp, linktype, offset, caplen in iter_frames(buffer):
+        ip = LINK_HEADER_LEN.get(linktype)
+        if ip is None:
+            continue
+        ip += offset
+        end = offset + caplen
+        if linktype == LINKTYPE_ETHERNET:
+            if ip > end:
+                continue
+            ethertype = struct.unpack_from('!H', buffer, ip - 2)[0]
+            if ethertype in ETHERTYPE_VLAN:
+                ip += 4
+                if ip > end:
+                    continue
+                ethertype = struct.unpack_from('!H', buffer, ip - 2)[0]
+            if ethertype != ETHERTYPE_IPV4:
+                continue
+        if ip + 28 > end:
+            continue
+        version_ihl, _, _, _, fragment, _, protocol, _, src_ip, dst_ip = \
+            struct.unpack_from('!BBHHHBBH4s4s', buffer, ip)
+        if version_ihl >> 4 != 4 or protocol != IPPROTO_UDP:
+            continue
+        if fragment & 0x3fff:
+            continue
+        udp = ip + (version_ihl & 0x0f) * 4
+        if udp + 8 > end:
+            continue
+        src_port, dst_port, length = struct.unpack_from('!HHH', buffer, udp)
+        yield (
+            timestamp,
+            (socket.inet_ntoa(src_ip), src_port),
+            (socket.inet_ntoa(dst_ip), dst_port),
+            bytes(buffer[udp + 8:min(end, udp + length)])
+        )
+
+
+def decode_pcap(path):
+    """Decodes every DHCP packet of a capture file into a structured array.
+
+    The returned array has one row per DHCP packet with the RECORD_FIELDS
+    columns. Addresses are integers in host order, 'chaddr' holds the first
+    six bytes of the hardware address as 48-bit integer. 'option82_offset'
+    and 'option82_len' point to the raw relay agent information in the file.
+
+    :param path: path of a pcap or pcapng file
+
+    """
+    with open_capture(path) as buffer:
+        return decode_buffer(buffer)
+
+
+def decode_buffer(buffer):
+    """Same as 'decode_pcap' for a capture file already in memory."""
+    if numpy is None:
+        raise ImportError('decode_buffer requires numpy')
+
+    if len(buffer) < 4:
+        raise PcapFormatError('File is too short')
+    # The file is validated and walked before the NumPy view exists: a
+    # live view keeps open_capture from closing the memory map.
+    pcap_header = None
+    if struct.unpack_from('<I', buffer)[0] == PCAPNG_SHB:
+        linktypes, frames = _frame_columns(buffer)
+    else:
+        pcap_header = _pcap_header(buffer)
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    try:
+        if pcap_header:
+            linktypes, frames = _pcap_frame_columns(buffer, data,
+                                                    *pcap_header)
+        return _decode_frames(data, linktypes, frames)
+    except Exception as error:
+        # Frames of the traceback still reference the view.
+        traceback.clear_frames(error.__traceback__)
+        raise
+    finally:
+        del data
+
+
+def _decode_frames(data, linktypes, frames):
+
+    # Link layer.
+    l2_len = numpy.full(len(frames['offset']), -1, dtype=numpy.int64)
+    for index, linktype in enumerate(linktypes):
+        if linktype in LINK_HEADER_LEN:
+            l2_len[frames['link'] == index] = LINK_HEADER_LEN[linktype]
+    frame_index = numpy.nonzero(
+        (l2_len >= 0) & (frames['caplen'] >= l2_len + 28 + BOOTP_LEN)
+    )[0]
+    start = frames['offset'][frame_index]
+    end = start + frames['caplen'][frame_index]
+    ip = start + l2_len[frame_index]
+
+    ethernet = l2_len[frame_index] == LINK_HEADER_LEN[LINKTYPE_ETHERNET]
+    if ethernet.any():
+        ethertype = _uint16(data, ip - 2)
+        vlan = ethernet & numpy.isin(ethertype, ETHERTYPE_VLAN)
+        ip[vlan] += 4
+        ethertype[vlan] = _uint16(data, ip[vlan] - 2)
+        keep = ~ethernet | (ethertype == ETHERTYPE_IPV4)
+        frame_index, start, end, ip = _select(keep, frame_index, start, end,
+                                              ip)
+
+    # IPv4 and UDP, non-fragmented datagrams to or from the DHCP ports.
+    keep = ip + 28 + BOOTP_LEN <= end
+    frame_index, start, end, ip = _select(keep, frame_index, start, end, ip)
+    version_ihl = data[ip]
+    udp = ip + (version_ihl & 0x0f).astype(numpy.int64) * 4
+    keep = (
+        (version_ihl >> 4 == 4)
+        & (data[ip + 9] == IPPROTO_UDP)
+        & ((_uint16(data, ip + 6) & 0x3fff) == 0)
+        & (udp + 8 + BOOTP_LEN <= end)
+    )
+    frame_index, start, end, ip, udp = _select(keep, frame_index, start,
+                                               end, ip, udp)
+    src_port = _uint16(data, udp)
+    dst_port = _uint16(data, udp + 2)
+    bootp = udp + 8
+    keep = (
+        (numpy.isin(src_port, DHCP_PORTS) | numpy.isin(dst_port, DHCP_PORTS))
+        & (_uint32(data, bootp + BOOTP_LEN - 4) == MAGIC_COOKIE)
+    )
+    frame_index, end, ip, udp, bootp, src_port, dst_port = _select(
+        keep, frame_index, end, ip, udp, bootp, src_port, dst_port
+    )
+    end = numpy.minimum(end, udp + _uint16(data, udp + 4))
+
+    records = numpy.zeros(len(frame_index), dtype=numpy.dtype(
+        list(RECORD_FIELDS)
+    ))
+    records['frame'] = frame_index
+    records['time'] = frames['time'][frame_index]
+    records['src_ip'] = _uint32(data, ip + 12)
+    records['dst_ip'] = _uint32(data, ip + 16)
+    records['src_port'] = src_port
+    records['dst_port'] = dst_port
+
+    # Fixed BOOTP header, gathered for all packets in one step.
+    header = data[
+        bootp[:, None] + numpy.arange(_BOOTP_FIELDS_LEN)
+    ].view(numpy.dtype(list(_BOOTP_FIELDS)))[:, 0]
+    for name, _ in RECORD_FIELDS[6:17]:
+        records[name] = header[name]
+    chaddr = header['chaddr'][:, :6].astype(numpy.uint64)
+    for index in range(6):
+        records['chaddr'] <<= numpy.uint64(8)
+        records['chaddr'] |= chaddr[:, index]
+
+    _scan_options(data, records, bootp + BOOTP_LEN, end)
+    return records
+
+
+def _frame_columns(buffer):
+    linktypes = []
+    times, links, offsets, caplens = (
+        array('d'), array('H'), array('q'), array('q')
+    )
+    for timestamp, linktype, offset, caplen in iter_frames(buffer):
+        if linktype not in linktypes:
+            linktypes.append(linktype)
+        times.append(timestamp)
+        links.append(linktypes.index(linktype))
+        offsets.append(offset)
+        caplens.append(caplen)
+    return linktypes, {
+        'time': numpy.frombuffer(times, dtype=numpy.float64),
+        'link': numpy.frombuffer(links, dtype=numpy.uint16),
+        'offset': numpy.frombuffer(offsets, dtype=numpy.int64),
+        'caplen': numpy.frombuffer(caplens, dtype=numpy.int64),
+    }
+
+
+def _pcap_frame_columns(buffer, data, order, resolution, linktype):
+    """Fast path for pcap: only the record lengths are read in Python."""
+    caplen_at = struct.Struct(order + 'I').unpack_from
+    records = array('q')
+    offset = PCAP_HEADER_LEN
+    size = len(buffer)
+    while offset + PCAP_RECORD_LEN <= size:
+        caplen = caplen_at(buffer, offset + 8)[0]
+        if offset + PCAP_RECORD_LEN + caplen > size:
+            break
+        records.append(offset)
+        offset += PCAP_RECORD_LEN + caplen
+    records = numpy.frombuffer(records, dtype=numpy.int64)
+    header = data[
+        records[:, None] + numpy.arange(PCAP_RECORD_LEN)
+    ].view(numpy.dtype([
+        ('ts_sec', order + 'u4'), ('ts_frac', order + 'u4'),
+        ('caplen', order + 'u4'), ('len', order + 'u4')
+    ]))[:, 0]
+    return [linktype], {
+        'time': header['ts_sec'] + header['ts_frac'] * resolution,
+        'link': numpy.zeros(len(records), dtype=numpy.uint16),
+        'offset': records + PCAP_RECORD_LEN,
+        'caplen': header['caplen'].astype(numpy.int64),
+    }
+
+
+def _scan_options(data, records, position, end):
+    """Walks the options of all packets in lock step."""
+    row = numpy.nonzero(position < end)[0]
+    position, end = position[row], end[row]
+    while len(row):
+        code = data[position]
+        done = (code == END_OPTION) | (position + 2 > end)
+        pad = ~done & (code == PAD_OPTION)
+        option = ~done & ~pad
+        length = numpy.zeros(len(row), dtype=numpy.int64)
+        length[option] = data[position[option] + 1]
+        value = position + 2
+        done |= option & (value + length > end)
+        option &= ~done
+
+        for code_value, (column, bit, size) in _OPTION_COLUMNS.items():
+            found = option & (code == code_value) & (length >= size)
+            if not found.any():
+                continue
+            where = row[found]
+            if size == 1:
+                records[column][where] = data[value[found]]
+            else:
+                records[column][where] = _uint32(data, value[found])
+            records['present'][where] |= bit
+        found = option & (code == 82)
+        if found.any():
+            where = row[found]
+            records['option82_offset'][where] = value[found]
+            records['option82_len'][where] = length[found]
+            records['present'][where] |= HAS_OPTION82
+
+        position = numpy.where(pad, position + 1, value + length)
+        keep = ~done & (position < end)
+        row, position, end = row[keep], position[keep], end[keep]
+
+
+def _select(mask, *columns):
+    return tuple(column[mask] for column in columns)
+
+
+def _uint16(data, index):
+    return (data[index].astype(numpy.uint32) << 8) | data[index + 1]
+
+
+def _uint32(data, index):
+    return (
+        (data[index].astype(numpy.uint32) << 24)
+        | (data[index + 1].astype(numpy.uint32) << 16)
+        | (data[index + 2].astype(numpy.uint32) << 8)
+        | data[index + 3]
+    )
@@ -0,0 +1,219 @@
+"""Relay agent information (option 82) policy engine.
+
+Rules match the circuit-id and/or the remote-id of a relayed message,
+exactly or by prefix. At load time they are compiled into hash tables:
+exact matches take one dictionary lookup, prefix matches one lookup per
+distinct prefix length. The sub-options are read straight from the raw
+packet, no option objects are created.
+
+Lookup order, first hit wins:
+
+    exact circuit-id and remote-id
+    exact remote-id
+    exact circuit-id
+    longest remote-id prefix
+    longest circuit-id prefix
+    default decision
+
+"""
+import ipaddress
+
+from .message import DHCPMessage
+from .error import DHCPConfigInitError
+
+
+AGENT_INFO_OPTION = 82
+CIRCUIT_ID = 1
+REMOTE_ID = 2
+
+
+def find_option(payload, code):
+    """Returns the raw value of option 'code' of a DHCP message or None."""
+    index = DHCPMessage.HEADER_LEN
+    end = len(payload)
+    while index < end:
+        option_code = payload[index]
+        if option_code == DHCPMessage.END_OPTIONS_FLAG:
+            break
+        if option_code == 0:
+            index += 1
+            continue
+        if index + 1 >= end:
+            break
+        length = payload[index + 1]
+        if option_code == code:
+            return bytes(payload[index + 2:index + 2 + length])
+        index += 2 + length
+    return None
+
+
+def agent_info(payload):
+    """Returns the raw (circuit-id, remote-id) of a DHCP message.
+
+    Missing sub-options are returned as None.
+
+    """
+    circuit_id = remote_id = None
+    value = find_option(payload, AGENT_INFO_OPTION)
+    if value is None:
+        return circuit_id, remote_id
+    index = 0
+    while index + 2 <= len(value):
+        code, length = value[index], value[index + 1]
+        if code == CIRCUIT_ID:
+            circuit_id = value[index + 2:index + 2 + length]
+        elif code == REMOTE_ID:
+            remote_id = value[index + 2:index + 2 + length]
+        index += 2 + length
+    return circuit_id, remote_id
+
+
+def _to_bytes(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    if isinstance(value, int):
+        return value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big')
+    return str(value).encode('ascii')
+
+
+class PolicyDecision(object):
+    """What a matching rule assigns to a client."""
+
+    def __init__(self, scope, pool=None, options=None):
+        """PolicyDecision initial.
+
+        :param scope: name of the scope
+        :param pool: tuple contains the start and end addresses the client
+            is allocated from, must lie within the server address range
+            (checked by Option82Policy.check_pools)
+        :param options: iterable object contains DHCPOption instances that
+            replace the server options with the same code
+
+        """
+        self.scope = scope
+        self.pool = None
+        if pool:
+            self.pool = tuple(ipaddress.IPv4Address(addr) for addr in pool)
+            if len(self.pool) != 2 or self.pool[0] > self.pool[1]:
+                raise DHCPConfigInitError(
+                    'Incorrect pool of scope {}'.format(scope)
+                )
+        self.options = {option.code: option for option in options or ()}
+
+    def __repr__(self):
+        return '{}(SCOPE: {} POOL: {})'.format(
+            self.__class__.__name__, self.scope, self.pool
+        )
+
+
+class Option82Policy(object):
+
+    def __init__(self, default=None):
+        """Option82Policy initial.
+
+        :param default: PolicyDecision used when no rule matches
+
+        """
+        self.default = default
+        self._rules = []
+        self._both = {}
+        self._circuit = {}
+        self._remote = {}
+        self._circuit_prefix = []
+        self._remote_prefix = []
+
+    def add_rule(self, decision, circuit_id=None, remote_id=None,
+                 prefix=False):
+        """Adds a rule; call 'compile' once all rules are added.
+
+        Values are bytes, strings (ASCII encoded) or integers.
+
+        :param prefix: match values starting with the given ones; a prefix
+            rule may name either circuit-id or remote-id
+
+        """
+        circuit_id = _to_bytes(circuit_id)
+        remote_id = _to_bytes(remote_id)
+        if circuit_id is None and remote_id is None:
+            raise ValueError('Rule must match circuit-id or remote-id')
+        if prefix and circuit_id is not None and remote_id is not None:
+            raise ValueError('Prefix rule must match one sub-option')
+        self._rules.append((decision, circuit_id, remote_id, prefix))
+
+    def compile(self):
+        both, circuit, remote = {}, {}, {}
+        circuit_prefix, remote_prefix = {}, {}
+        # Earlier rules win, so they are inserted last.
+        for decision, circuit_id, remote_id, prefix in reversed(self._rules):
+            if prefix:
+                tables, value = ((circuit_prefix, circuit_id)
+                                 if circuit_id is not None
+                                 else (remote_prefix, remote_id))
+                tables.setdefault(len(value), {})[value] = decision
+            elif circuit_id is not None and remote_id is not None:
+                both[(circuit_id, remote_id)] = decision
+            elif circuit_id is not None:
+                circuit[circuit_id] = decision
+            else:
+                remote[remote_id] = decision
+        self._both = both
+        self._circuit = circuit
+        self._remote = remote
+        self._circuit_prefix = sorted(circuit_prefix.items(), reverse=True)
+        self._remote_prefix = sorted(remote_prefix.items(), reverse=True)
+
+    def decisions(self):
+        """Yields the default decision and the decision of every rule."""
+        if self.default:
+            yield self.default
+        for rule in self._rules:
+            yield rule[0]
+
+    def check_pools(self, addr_range):
+        """Raises DHCPConfigInitError if a pool is outside 'addr_range'.
+
+        A client matching such a decision would never get an offer.
+
+        :param addr_range: (start, end) IPv4Address tuple of the server
+
+        """
+        start, end = addr_range
+        for decision in self.decisions():
+            if decision.pool and not (start <= decision.pool[0] and
+                                      decision.pool[1] <= end):
+                raise DHCPConfigInitError(
+                    'Pool {}-{} of scope {} is outside the address '
+                    'range'.format(decision.pool[0], decision.pool[1],
+                                   decision.scope)
+                )
+
+    def decide(self, payload):
+        """Returns the PolicyDecision for a raw DHCP message."""
+        circuit_id, remote_id = agent_info(payload)
+        return self.lookup(circuit_id, remote_id)
+
+    def lookup(self, circuit_id, remote_id):
+        if circuit_id is None and remote_id is None:
+            return self.default
+        decision = self._both.get((circuit_id, remote_id))
+        if decision:
+            return decision
+        if remote_id is not None:
+            decision = self._remote.get(remote_id)
+            if decision:
+                return decision
+        if circuit_id is not None:
+            decision = self._circuit.get(circuit_id)
+            if decision:
+                return decision
+        for value, tables in ((remote_id, self._remote_prefix),
+                              (circuit_id, self._circuit_prefix)):
+            if value is None:
+                continue
+            for length, table in tables:
+                if length > len(value):
+                    continue
+                decision = table.get(value[:length])
+                if decision:
+                    return decision
+        return self.default
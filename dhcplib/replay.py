@@ -0,0 +1,381 @@
+"""Replay of captured DHCP client traffic against DHCPServer.
+
+Client messages are preloaded from a capture, optionally rewritten so that
+one capture is spread over many clients, and fed to the server either
+in-process (straight into DHCPServer.handler through a MemoryUDPServer) or
+through a UDP socket. Server replies are checked against the replies
+recorded in the capture.
+
+"""
+import time
+import socket
+import struct
+import threading
+from collections import deque
+
+from .pcap import open_capture, iter_udp_payloads
+from .udp import MemoryUDPServer
+
+
+SERVER_PORT = 67
+CLIENT_PORT = 68
+
+# Offsets of the rewritten BOOTP fields.
+XID_OFFSET = 4
+CIADDR_OFFSET = 12
+YIADDR_OFFSET = 16
+GIADDR_OFFSET = 24
+CHADDR_OFFSET = 28
+
+DHCPOFFER = 2
+DHCPACK = 5
+REQUESTED_IP_OPTION = 50
+
+# Reply expected for each client message type (option 53).
+EXPECTED_REPLIES = {
+    1: (2,),        # DHCPDISCOVER -> DHCPOFFER
+    3: (5, 6),      # DHCPREQUEST -> DHCPACK / DHCPNAK
+    8: (5,),        # DHCPINFORM -> DHCPACK
+    10: (11, 12, 13),  # DHCPLEASEQUERY -> UNASSIGNED / UNKNOWN / ACTIVE
+}
+
+XID_STRIDE = 0x9e3779b1
+
+
+def option_offset(payload, code, length=1):
+    """Returns the offset of the value of option 'code' or None.
+
+    :param length: minimum value length the option must have
+
+    """
+    index = 240
+    end = len(payload)
+    while index < end:
+        option_code = payload[index]
+        if option_code == 255:
+            break
+        if option_code == 0:
+            index += 1
+            continue
+        if index + 1 >= end:
+            break
+        option_length = payload[index + 1]
+        if option_code == code:
+            if option_length >= length and index + 2 + length <= end:
+                return index + 2
+            return None
+        index += 2 + option_length
+    return None
+
+
+def message_type(payload):
+    """Returns the option 53 value of a raw DHCP message or None."""
+    index = option_offset(payload, 53)
+    return None if index is None else payload[index]
+
+
+def message_key(payload):
+    """Returns the (xid, chaddr) pair identifying a client transaction."""
+    xid, = struct.unpack_from('!I', payload, XID_OFFSET)
+    return xid, payload[CHADDR_OFFSET:CHADDR_OFFSET + 6]
+
+
+class Capture(object):
+    """Client messages and recorded server replies of a capture file."""
+
+    def __init__(self, requests, replies):
+        """Capture initial.
+
+        :param requests: list of (timestamp, payload) sent to the server
+        :param replies: dict (xid, chaddr) -> list of (type, yiaddr)
+
+        """
+        self.requests = requests
+        self.replies = replies
+
+    @classmethod
+    def load(cls, path, server_port=SERVER_PORT):
+        requests = []
+        replies = {}
+        with open_capture(path) as buffer:
+            for timestamp, src, dst, payload in iter_udp_payloads(buffer):
+                if len(payload) < 240:
+                    continue
+                if dst[1] == server_port:
+                    requests.append((timestamp, payload))
+                elif src[1] == server_port:
+                    replies.setdefault(message_key(payload), []).append(
+                        (message_type(payload), payload[16:20])
+                    )
+        return cls(requests, replies)
+
+
+class ReplayResult(object):
+
+    def __init__(self):
+        self.sent = 0
+        self.replies = 0
+        self.elapsed = 0.0
+        self.latencies = []
+        self.mismatches = []
+
+    def __str__(self):
+        return (
+            '{}(SENT: {} REPLIES: {} THROUGHPUT: {:.0f}/s P50: {:.1f}us '
+            'P99: {:.1f}us MISMATCHES: {})'.format(
+                self.__class__.__name__, self.sent, self.replies,
+                self.throughput, self.percentile(50) * 1e6,
+                self.percentile(99) * 1e6, len(self.mismatches)
+            )
+        )
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, value):
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, len(latencies) * value // 100)
+        return latencies[int(index)]
+
+
+class Replayer(object):
+    """Feeds the client messages of a Capture to a DHCPServer."""
+
+    def __init__(self, capture, loops=1, rewrite_xid=False,
+                 rewrite_chaddr=False, giaddr=None, timing=False, speed=1.0,
+                 verify=True):
+        """Replayer initial.
+
+        :param capture: Capture instance
+        :param loops: number of times the capture is replayed
+        :param rewrite_xid: give every loop its own transaction IDs
+        :param rewrite_chaddr: give every loop its own client MACs, so the
+            capture is spread over 'loops' times as many clients; only
+            'run_in_process' follows the addresses the server assigns to
+            them, see 'run_socket'
+        :param giaddr: relay agent address written to every message
+        :param timing: keep the original inter-packet gaps
+        :param speed: time scale used with 'timing'
+        :param verify: compare replies to the recorded ones
+
+        """
+        self.capture = capture
+        self.loops = loops
+        self.rewrite_xid = rewrite_xid
+        self.rewrite_chaddr = rewrite_chaddr
+        self.giaddr = socket.inet_aton(giaddr) if giaddr else None
+        self.timing = timing
+        self.speed = speed
+        self.verify = verify
+
+    def packets(self):
+        """Returns the rewritten payloads as (timestamp, original, payload).
+
+        Everything is rewritten upfront so the replay loop only sends.
+
+        """
+        packets = []
+        duration = 0.0
+        if self.capture.requests:
+            duration = (self.capture.requests[-1][0] -
+                        self.capture.requests[0][0])
+        for loop in range(self.loops):
+            for timestamp, payload in self.capture.requests:
+                packets.append((
+                    timestamp + loop * duration,
+                    payload,
+                    self.rewrite(payload, loop)
+                ))
+        return packets
+
+    def rewrite(self, payload, loop):
+        if not (self.giaddr or (loop and (self.rewrite_xid or
+                                          self.rewrite_chaddr))):
+            return payload
+        payload = bytearray(payload)
+        if loop and self.rewrite_xid:
+            xid, = struct.unpack_from('!I', payload, XID_OFFSET)
+            struct.pack_into('!I', payload, XID_OFFSET,
+                             (xid + loop * XID_STRIDE) & 0xffffffff)
+        if loop and self.rewrite_chaddr:
+            chaddr = int.from_bytes(
+                payload[CHADDR_OFFSET:CHADDR_OFFSET + 6], 'big'
+            ) ^ (loop << 24)
+            payload[CHADDR_OFFSET:CHADDR_OFFSET + 6] = \
+                (chaddr & 0xffffffffffff).to_bytes(6, 'big')
+        if self.giaddr:
+            payload[GIADDR_OFFSET:GIADDR_OFFSET + 4] = self.giaddr
+        return bytes(payload)
+
+    def run_in_process(self, server):
+        """Calls server.handler directly for every packet.
+
+        The server must be built with transport=MemoryUDPServer. Clients
+        with a rewritten chaddr are given other addresses than the recorded
+        ones, so their requested address (option 50) and ciaddr are
+        rewritten to the address last offered or acknowledged to them.
+
+        """
+        if not isinstance(server.udp_server, MemoryUDPServer):
+            raise ValueError('Server transport must be MemoryUDPServer')
+        sent = server.udp_server.sent
+        handler = server.handler
+        result = ReplayResult()
+        packets = self.packets()
+        perf_counter = time.perf_counter
+        clock = self._clock(packets)
+        assigned = {}
+        started = perf_counter()
+        for timestamp, original, payload in packets:
+            if clock:
+                clock(timestamp)
+            chaddr = payload[CHADDR_OFFSET:CHADDR_OFFSET + 6]
+            rewritten = chaddr != original[CHADDR_OFFSET:CHADDR_OFFSET + 6]
+            if rewritten and chaddr in assigned:
+                payload = self._rewrite_address(payload, assigned[chaddr])
+            sent.clear()
+            start = perf_counter()
+            handler((payload, ('0.0.0.0', CLIENT_PORT)))
+            result.latencies.append(perf_counter() - start)
+            result.sent += 1
+            reply = sent[-1][0] if sent else None
+            if reply:
+                result.replies += 1
+                if rewritten and message_type(reply) in (DHCPOFFER, DHCPACK):
+                    assigned[chaddr] = reply[YIADDR_OFFSET:YIADDR_OFFSET + 4]
+            if self.verify:
+                self._verify(result, original, payload, reply)
+        result.elapsed = perf_counter() - started
+        return result
+
+    def run_socket(self, address, listen_port=CLIENT_PORT, timeout=1.0):
+        """Sends every packet to 'address' through a UDP socket.
+
+        Replies are collected on 'listen_port' by a background thread and
+        matched to the oldest outstanding message of the same transaction
+        (xid, chaddr) whose type they answer (EXPECTED_REPLIES).
+
+        Requests are sent as recorded: with 'rewrite_chaddr' the clients of
+        later loops ask for the recorded addresses, which the server has
+        given to the clients of the first loop, and are not acknowledged.
+        Use 'run_in_process' to replay a capture over more clients.
+
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind(('', listen_port))
+        sock.settimeout(timeout)
+
+        result = ReplayResult()
+        packets = self.packets()
+        pending = {}
+        received = []
+        stopped = threading.Event()
+
+        def receive():
+            while not stopped.is_set():
+                try:
+                    reply, _ = sock.recvfrom(4096)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                received.append((time.perf_counter(), reply))
+
+        receiver = threading.Thread(target=receive, daemon=True)
+        receiver.start()
+        clock = self._clock(packets)
+        started = time.perf_counter()
+        try:
+            for timestamp, original, payload in packets:
+                if clock:
+                    clock(timestamp)
+                pending.setdefault(message_key(payload), deque()).append(
+                    (time.perf_counter(), original, payload)
+                )
+                sock.sendto(payload, address)
+                result.sent += 1
+            result.elapsed = time.perf_counter() - started
+            time.sleep(timeout)
+        finally:
+            stopped.set()
+            receiver.join()
+            sock.close()
+
+        for received_at, reply in received:
+            outstanding = pending.get(message_key(reply))
+            if not outstanding:
+                continue
+            reply_type = message_type(reply)
+            for item in outstanding:
+                if reply_type in EXPECTED_REPLIES.get(message_type(item[1]),
+                                                      ()):
+                    break
+            else:
+                continue
+            outstanding.remove(item)
+            sent_at, original, payload = item
+            result.replies += 1
+            result.latencies.append(received_at - sent_at)
+            if self.verify:
+                self._verify(result, original, payload, reply)
+        return result
+
+    @staticmethod
+    def _rewrite_address(payload, address):
+        """Replaces the requested address and a set ciaddr by 'address'."""
+        payload = bytearray(payload)
+        if payload[CIADDR_OFFSET:CIADDR_OFFSET + 4] != bytes(4):
+            payload[CIADDR_OFFSET:CIADDR_OFFSET + 4] = address
+        index = option_offset(payload, REQUESTED_IP_OPTION, 4)
+        if index is not None:
+            payload[index:index + 4] = address
+        return bytes(payload)
+
+    def _clock(self, packets):
+        if not self.timing or not packets:
+            return None
+        first = packets[0][0]
+        started = time.perf_counter()
+
+        def wait(timestamp):
+            delay = (timestamp - first) / self.speed - (
+                time.perf_counter() - started
+            )
+            if delay > 0:
+                time.sleep(delay)
+        return wait
+
+    def _verify(self, result, original, payload, reply):
+        """Compares a reply with the recorded one.
+
+        The message type must match; the address (yiaddr) too, unless the
+        client or relay address of the sent message was rewritten, since
+        the server then legitimately assigns another one.
+
+        """
+        request_type = message_type(original)
+        expected = self.capture.replies.get(message_key(original))
+        if expected is None or request_type not in EXPECTED_REPLIES:
+            return
+        recorded = [item for item in expected
+                    if item[0] in EXPECTED_REPLIES[request_type]]
+        if not recorded:
+            return
+        got = (message_type(reply), reply[16:20]) if reply else None
+        if got is None or got[0] != recorded[0][0]:
+            result.mismatches.append((original, recorded[0], got))
+            return
+        rewritten = (
+            payload[CHADDR_OFFSET:CHADDR_OFFSET + 6] !=
+            original[CHADDR_OFFSET:CHADDR_OFFSET + 6] or
+            payload[GIADDR_OFFSET:GIADDR_OFFSET + 4] !=
+            original[GIADDR_OFFSET:GIADDR_OFFSET + 4]
+        )
+        if not rewritten and got[1] != recorded[0][1]:
+            result.mismatches.append((original, recorded[0], got))
@@ -0,0 +1,350 @@
+"""Lease state replication between a pair of DHCP servers.
+
+Binding changes of the local LeaseTable are streamed to the peer over one
+TCP connection as batches of fixed-size binary records. Changed slots are
+coalesced in a set and flushed by a sender thread, so the packet handler
+never waits for the peer. After every (re)connect both sides send their
+whole table (bulk resynchronization).
+
+Record format (23 bytes, network byte order):
+
+    ip          uint32
+    state       uint8
+    chaddr      6 bytes
+    xid         uint32
+    remaining   uint32  seconds until expiry
+    age         uint32  seconds since the slot last changed
+
+Expiry and change time go over the wire as relative seconds because
+monotonic clocks of two hosts are not comparable. The change time lets a
+release made while the pair was disconnected win over the stale binding
+the peer sends back during bulk resynchronization, so released slots are
+part of the bulk stream as well.
+
+Operating modes (see RFC 3074 for load balancing):
+
+    HOT_STANDBY    the primary answers everything, the secondary only
+                   while the peer is unreachable;
+    LOAD_BALANCE   each server answers the clients of its hash buckets;
+    SPLIT_SCOPE    both servers answer every client.
+
+In LOAD_BALANCE and SPLIT_SCOPE free addresses are split between the
+servers by slot parity, so both can allocate without conflicts. Client
+buckets are computed with CRC-32 instead of the RFC 3074 Pearson table.
+
+"""
+import zlib
+import socket
+import struct
+import threading
+from array import array
+
+from .lease import LeaseTable, ConcurrentLeaseTable
+from .error import DHCPServerInitError
+
+
+PRIMARY = 0
+SECONDARY = 1
+
+# Modes.
+HOT_STANDBY = 0
+LOAD_BALANCE = 1
+SPLIT_SCOPE = 2
+
+# Frame types.
+HELLO = 0
+UPDATE = 1
+BULK = 2
+
+FRAME_HEADER = struct.Struct('!BH')
+HELLO_FORMAT = struct.Struct('!BII')
+RECORD = struct.Struct('!IB6sIII')
+MAX_REMAINING = 0xffffffff
+# Change time of a slot that never changed since the replicator started.
+NEVER = -1
+HASH_BUCKETS = 256
+
+
+def client_bucket(chaddr):
+    """Returns the load balancing bucket (0-255) of a client MAC string."""
+    return zlib.crc32(bytes.fromhex(chaddr.replace(':', ''))) % HASH_BUCKETS
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Peer closed the connection')
+        data += chunk
+    return data
+
+
+class LeaseReplicator(object):
+    """One side of a replicated DHCPServer pair."""
+
+    BATCH_SIZE = 1024
+    FLUSH_INTERVAL = 0.005
+    RECONNECT_INTERVAL = 1.0
+    STAMP_TYPE = 'q'
+
+    def __init__(self, server, address, role=PRIMARY, mode=HOT_STANDBY,
+                 batch_size=None, flush_interval=None):
+        """LeaseReplicator initial.
+
+        :param server: DHCPServer instance with a ConcurrentLeaseTable, the
+            replicator writes peer records from its own thread
+        :param address: (host, port); the primary listens on it and the
+            secondary connects to it
+        :param role: PRIMARY or SECONDARY
+        :param mode: HOT_STANDBY, LOAD_BALANCE or SPLIT_SCOPE
+        :param batch_size: max records per frame
+        :param flush_interval: max seconds a change waits to be sent
+
+        """
+        if not isinstance(server.leases, ConcurrentLeaseTable):
+            raise DHCPServerInitError(
+                'Replication requires lease_store=ConcurrentLeaseTable'
+            )
+        self.server = server
+        self.table = server.leases
+        self._stamps = array(self.STAMP_TYPE, [NEVER]) * len(self.table)
+        self.address = address
+        self.role = role
+        self.mode = mode
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.flush_interval = flush_interval or self.FLUSH_INTERVAL
+        self.connected = threading.Event()
+        self.sent = 0
+        self.received = 0
+        self._dirty = set()
+        self._dirty_cond = threading.Condition()
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+        self.table.subscribe(self._on_change)
+        server.replicator = self
+
+    def start(self):
+        for target in (self._connection_loop, self._sender_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        with self._dirty_cond:
+            self._dirty_cond.notify_all()
+        self._close()
+        for thread in self._threads:
+            thread.join()
+
+    def resync(self):
+        """Drops pending updates and the connection, see LeaseTable.resize.
+
+        Both servers must be reloaded with the same address range; the
+        next connection then starts with a bulk resynchronization.
+
+        """
+        with self._dirty_cond:
+            self._dirty.clear()
+            self._stamps = array(self.STAMP_TYPE, [NEVER]) * len(self.table)
+        self._close()
+
+    def serves(self, chaddr):
+        """Checks whether this server answers a DHCPDISCOVER of 'chaddr'."""
+        if not self.connected.is_set() or self.mode == SPLIT_SCOPE:
+            return True
+        if self.mode == HOT_STANDBY:
+            return self.role == PRIMARY
+        bucket = client_bucket(chaddr)
+        return (bucket < HASH_BUCKETS // 2) == (self.role == PRIMARY)
+
+    def share(self):
+        """Returns the 'share' argument for LeaseTable.offer."""
+        if self.mode == HOT_STANDBY:
+            return None
+        return self.role, 2
+
+    def _on_change(self, index):
+        stamps = self._stamps
+        if index < len(stamps):
+            stamps[index] = self.server._now()
+        with self._dirty_cond:
+            self._dirty.add(index)
+            if len(self._dirty) >= self.batch_size:
+                self._dirty_cond.notify()
+
+    def _connection_loop(self):
+        listener = None
+        if self.role == PRIMARY:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.settimeout(self.RECONNECT_INTERVAL)
+            listener.bind(self.address)
+            listener.listen(1)
+        try:
+            while not self._stopped.is_set():
+                sock = self._accept(listener) if listener else self._connect()
+                if sock is None:
+                    continue
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    self._session(sock)
+                except (OSError, ConnectionError, ValueError, IndexError):
+                    # IndexError: a record applied while a reload shrank
+                    # the table, resync drops the session anyway.
+                    pass
+                finally:
+                    self._close()
+                # A mismatching peer (e.g. reloaded with another range)
+                # would otherwise be reconnected to in a tight loop.
+                self._stopped.wait(self.RECONNECT_INTERVAL)
+        finally:
+            if listener:
+                listener.close()
+
+    def _accept(self, listener):
+        try:
+            sock, _ = listener.accept()
+        except socket.timeout:
+            return None
+        sock.settimeout(None)
+        return sock
+
+    def _connect(self):
+        try:
+            return socket.create_connection(self.address,
+                                            timeout=self.RECONNECT_INTERVAL)
+        except OSError:
+            self._stopped.wait(self.RECONNECT_INTERVAL)
+            return None
+
+    def _session(self, sock):
+        sock.settimeout(None)
+        sock.sendall(FRAME_HEADER.pack(HELLO, 1) + HELLO_FORMAT.pack(
+            self.role, int(self.table.start), len(self.table)
+        ))
+        frame_type, _ = FRAME_HEADER.unpack(
+            _recv_exact(sock, FRAME_HEADER.size)
+        )
+        role, start, size = HELLO_FORMAT.unpack(
+            _recv_exact(sock, HELLO_FORMAT.size)
+        )
+        if frame_type != HELLO or role == self.role or \
+                (start, size) != (int(self.table.start), len(self.table)):
+            raise ValueError('Peer does not match')
+
+        with self._dirty_cond:
+            self._dirty.clear()
+            self._sock = sock
+        self._send_bulk(sock)
+        self.connected.set()
+        while True:
+            frame_type, count = FRAME_HEADER.unpack(
+                _recv_exact(sock, FRAME_HEADER.size)
+            )
+            payload = _recv_exact(sock, count * RECORD.size)
+            self._apply(payload, bulk=frame_type == BULK)
+
+    def _close(self):
+        self.connected.clear()
+        with self._dirty_cond:
+            sock, self._sock = self._sock, None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def _send_bulk(self, sock):
+        now = self.server._now()
+        batch = []
+        stamps = self._stamps
+        for index in range(len(self.table)):
+            state = self.table.slot(index)[0]
+            if state == LeaseTable.RESERVED or (state == LeaseTable.FREE and
+                                                stamps[index] == NEVER):
+                continue
+            batch.append(self._encode(index, now))
+            if len(batch) == self.batch_size:
+                self._send_frame(sock, BULK, batch)
+                batch = []
+        if batch:
+            self._send_frame(sock, BULK, batch)
+
+    def _sender_loop(self):
+        while not self._stopped.is_set():
+            with self._dirty_cond:
+                if not self._dirty:
+                    self._dirty_cond.wait(self.flush_interval)
+                sock = self._sock
+                if not self._dirty or sock is None:
+                    continue
+                dirty, self._dirty = self._dirty, set()
+            now = self.server._now()
+            records = [self._encode(index, now) for index in sorted(dirty)]
+            try:
+                for offset in range(0, len(records), self.batch_size):
+                    self._send_frame(
+                        sock, UPDATE, records[offset:offset + self.batch_size]
+                    )
+            except OSError:
+                self._close()
+
+    def _send_frame(self, sock, frame_type, records):
+        frame = FRAME_HEADER.pack(frame_type, len(records)) + b''.join(records)
+        with self._send_lock:
+            sock.sendall(frame)
+            self.sent += len(records)
+
+    def _encode(self, index, now):
+        state, chaddr, xid, expiry = self.table.slot(index)
+        remaining = min(max(expiry - now, 0), MAX_REMAINING)
+        stamps = self._stamps
+        stamp = stamps[index] if index < len(stamps) else NEVER
+        age = MAX_REMAINING if stamp == NEVER else \
+            min(max(now - stamp, 0), MAX_REMAINING)
+        return RECORD.pack(
+            int(self.table.address(index)), state,
+            chaddr.to_bytes(6, 'big'), xid, remaining, age
+        )
+
+    def _apply(self, payload, bulk=False):
+        """Applies peer records.
+
+        Updates always win: the peer made the change. During bulk
+        resynchronization the slot changed last is kept, so a release
+        made on either side while disconnected is not undone; if neither
+        side knows when the slot changed, the binding that expires later
+        is kept.
+
+        """
+        now = self.server._now()
+        stamps = self._stamps
+        for ip, state, chaddr, xid, remaining, age in \
+                RECORD.iter_unpack(payload):
+            index = self.table.index(ip)
+            if index is None:
+                continue
+            local_state, _, _, local_expiry = self.table.slot(index)
+            if local_state == LeaseTable.RESERVED:
+                continue
+            expiry = now + remaining
+            stamp = NEVER if age == MAX_REMAINING else now - age
+            if bulk and self._local_wins(index, now, stamp, local_expiry,
+                                         expiry):
+                continue
+            self.table.load(index, state, int.from_bytes(chaddr, 'big'),
+                            xid, expiry)
+            stamps[index] = stamp
+            self.received += 1
+
+    def _local_wins(self, index, now, stamp, local_expiry, expiry):
+        local_stamp = self._stamps[index]
+        if local_stamp != stamp:
+            return local_stamp > stamp
+        return self.table.state(index, now) != LeaseTable.FREE and \
+            local_expiry > expiry
@@ -1,13 +1,14 @@
-import datetime
+import time
 import ipaddress
 
 from .utils import is_iterable
+from .lease import LeaseTable, mac_to_int
 from .message import DHCPMessage
-from .udp import UDPServer
+from .udp import UDPServer, BROADCAST
 from .error import DHCPConfigInitError, DHCPServerInitError
 from .options import (
     DHCPOption53, DHCPOption1, DHCPOption3, DHCPOption51, DHCPOption54,
-    DHCPOption6, DHCPOption15
+    DHCPOption6, DHCPOption15, PackedOption
 )
 
 
@@ -15,6 +16,8 @@ class DHCPServerConfig(object):
     """This class used for DHCPServer configuration."""
 
     EXCLUDED_PREFIX = (31, 32)
+    FIELDS = ('net', 'addr_range', 'dns', 'gateway', 'domain', 'lease_time',
+              'identifier')
 
     def __init__(self, net, addr_range=None, dns=None, gateway=None,
                  domain=None, lease_time=3600, identifier=None):
@@ -71,7 +74,7 @@ class DHCPServerConfig(object):
             self.dns = self._init_ip_param(dns)
 
         if gateway:
-            self.gateway = self._init_ip_param(dns)
+            self.gateway = self._init_ip_param(gateway)
 
         if not isinstance(lease_time, int):
             raise DHCPConfigInitError('Lease time must be "int" type')
@@ -80,6 +83,11 @@ class DHCPServerConfig(object):
             raise DHCPConfigInitError('Incorrect lease time')
         self.lease_time = lease_time
 
+    def diff(self, other):
+        """Returns the set of FIELDS whose values differ in 'other'."""
+        return {field for field in self.FIELDS
+                if getattr(self, field) != getattr(other, field)}
+
     def _check_ip(self, ip):
         if all(ip != addr for addr in self.excluded_addr) and ip in self.net:
             return True
@@ -100,34 +108,131 @@ class DHCPServerConfig(object):
 class DHCPServer(object):
 
     # Binding states.
-    FREE = 0
-    ACTIVE = 1
-    OFFERED = 2
+    FREE = LeaseTable.FREE
+    ACTIVE = LeaseTable.ACTIVE
+    OFFERED = LeaseTable.OFFERED
+
+    # Seconds an offered address stays reserved.
+    OFFER_TIMEOUT = 60
 
-    def __init__(self, config, listen_port=67):
+    def __init__(self, config, listen_port=67, transport=UDPServer,
+                 clock=time.monotonic, policy=None, lease_store=LeaseTable):
         """DHCPServer initial.
 
         :param config: DHCPServerConfig instance.
+        :param transport: callable taking (listen_port, handler) and
+            returning the server the messages are received from and sent
+            to, e.g. UDPServer or MemoryUDPServer.
+        :param clock: callable returning the current time in seconds, used
+            for lease expiry.
+        :param policy: compiled Option82Policy selecting pool and options
+            of relayed clients.
+        :param lease_store: lease table class, ConcurrentLeaseTable when
+            handlers run on several threads; called with the address range
+            and clock=clock.
 
         """
         if not isinstance(config, DHCPServerConfig):
             raise DHCPServerInitError(
                 'config must be DHCPServerConfig instance'
             )
-        self.udp_server = UDPServer(listen_port, self.handler)
+        if policy:
+            policy.check_pools(config.addr_range)
+        self.listen_port = listen_port
+        self.udp_server = transport(listen_port, self.handler)
         self.config = config
-        self.leases = {}
-        self.options = [
-            DHCPOption1(self.config.net.netmask.exploded),
-            DHCPOption51(self.config.lease_time),
-            DHCPOption54(self.config.identifier.exploded)
+        self.clock = clock
+        self.replicator = None
+        self.lease_index = None
+        self.policy = policy
+        self.leases = lease_store(*self.config.addr_range, clock=clock)
+        for addr in self.config.excluded_addr:
+            index = self.leases.index(addr)
+            if index is not None:
+                self.leases.reserve(index)
+        # Server options and a per-decision cache of the merged reply
+        # options, both pre-encoded; replaced as one tuple on reload.
+        self._reply_sets = (self._build_options(self.config), {})
+
+    @property
+    def options(self):
+        return self._reply_sets[0]
+
+    @staticmethod
+    def _build_options(config):
+        options = [
+            DHCPOption1(config.net.netmask.exploded),
+            DHCPOption51(config.lease_time),
+            DHCPOption54(config.identifier.exploded)
         ]
-        if self.config.gateway:
-            self.options.append(DHCPOption3(self.config.gateway))
-        if self.config.dns:
-            self.options.append(DHCPOption6(self.config.dns))
-        if self.config.domain:
-            self.options.append(DHCPOption15(self.config.domain))
+        if config.gateway:
+            options.append(DHCPOption3(config.gateway))
+        if config.dns:
+            options.append(DHCPOption6(config.dns))
+        if config.domain:
+            options.append(DHCPOption15(config.domain))
+        return [PackedOption(option) for option in options]
+
+    def reload(self, config, policy=None):
+        """Applies a new configuration without rebuilding the lease table.
+
+        Only what differs from the running configuration is touched: the
+        pool is resized by the added and removed ranges, the excluded
+        addresses are reserved again and the reply options are re-encoded
+        and swapped in at once. Bindings inside the new pool are kept. A
+        policy pool outside the new range raises DHCPConfigInitError before
+        anything is changed.
+
+        A changed address range resizes the lease table under the handlers.
+        With the default LeaseTable call reload on the thread running the
+        handler (e.g. between two start_handle calls of a MemoryUDPServer)
+        or while no packet is being handled; use a ConcurrentLeaseTable
+        lease_store to reload from another thread.
+
+        :param config: DHCPServerConfig instance
+        :param policy: compiled Option82Policy replacing the current one
+        :return: list of Lease records of the bindings that were evicted
+
+        """
+        if not isinstance(config, DHCPServerConfig):
+            raise DHCPServerInitError(
+                'config must be DHCPServerConfig instance'
+            )
+        new_policy = policy if policy is not None else self.policy
+        if new_policy:
+            new_policy.check_pools(config.addr_range)
+        changed = self.config.diff(config)
+        now = self._now()
+        evicted = []
+        if 'addr_range' in changed:
+            evicted.extend(self.leases.resize(*config.addr_range, now=now))
+            if self.lease_index:
+                self.lease_index.rebuild()
+            if self.replicator:
+                self.replicator.resync()
+        if changed & {'addr_range', 'net', 'identifier'}:
+            excluded = set(config.excluded_addr)
+            for addr in self.config.excluded_addr:
+                index = self.leases.index(addr)
+                if addr not in excluded and index is not None:
+                    self.leases.unreserve(index)
+            for addr in excluded:
+                index = self.leases.index(addr)
+                if index is None:
+                    continue
+                lease = self.leases.get(addr, now=now)
+                if lease and lease.state != self.FREE:
+                    evicted.append(lease)
+                self.leases.reserve(index)
+
+        if policy is not None:
+            self.policy = policy
+        if changed or policy is not None:
+            options = self._build_options(config) if changed else \
+                self.options
+            self._reply_sets = (options, {})
+        self.config = config
+        return evicted
 
     def start(self):
         try:
@@ -137,17 +242,19 @@ class DHCPServer(object):
         exit(1)
 
     def handler(self, data):
-        self._update_leases()
         payload, ip_port = data
         message = DHCPMessage.from_bytes(payload)
 
         dhcp_message_type = message.option53.value
         message_to_send = None
+        decision = self.policy.decide(payload) if self.policy else None
 
         if dhcp_message_type == DHCPOption53.DHCPDISCOVER:
-            message_to_send = self.dhcp_discover_handler(message)
+            message_to_send = self.dhcp_discover_handler(message, decision)
         elif dhcp_message_type == DHCPOption53.DHCPREQUEST:
-            message_to_send = self.dhcp_request_handler(message)
+            message_to_send = self.dhcp_request_handler(message, decision)
+            if message_to_send and self.lease_index:
+                self.lease_index.annotate(message_to_send.yiaddr, payload)
         elif dhcp_message_type == DHCPOption53.DHCPRELEASE:
             self.dhcp_release_handler(message)
             return None
@@ -156,95 +263,176 @@ class DHCPServer(object):
             return None
         elif dhcp_message_type == DHCPOption53.DHCPINFORM:
             pass
+        elif dhcp_message_type == DHCPOption53.DHCPLEASEQUERY:
+            self.dhcp_leasequery_handler(message, ip_port)
+            return None
 
         if message_to_send:
-            self.udp_server.send_data(message_to_send.pack(), ip_port[1])
-
-    def _ip_range_generator(self):
-        start_host, end_host = self.config.addr_range
-        host = start_host
-        while host <= end_host:
-            yield host
-            host += 1
-
-    def _get_free_ip(self, chaddr, xid):
-        for host in self._ip_range_generator():
-            ip = host.exploded
-            lease = self.leases.get(ip)
-            time_end = datetime.datetime.now() + datetime.timedelta(seconds=60)
-            if not lease:
-                self.leases[ip] = {
-                    'chaddr': chaddr,
-                    'state': self.OFFERED,
-                    '_xid': xid,
-                    'end_time': time_end
-                }
-                return ip
-            if lease['chaddr'] == chaddr or lease['state'] == self.FREE:
-                lease.update(
-                    chaddr=chaddr,
-                    state=self.OFFERED,
-                    xid=xid,
-                    end_time=time_end
-                )
-                return ip
-        return None
+            addr, port, chaddr = self._reply_address(message, message_to_send,
+                                                     ip_port[1])
+            self.udp_server.send_data(message_to_send.pack(), port, addr,
+                                      chaddr)
+
+    def _reply_address(self, message, reply, client_port):
+        """Returns (addr, port, chaddr) a reply is sent to (RFC 2131 4.1).
+
+        :param message: received message
+        :param reply: message to send
+        :param client_port: source port of the received message
 
-    def _get_lease(self, message, check_xid=True, req_ip=None):
-        if message.option54.value != self.config.identifier:
+        """
+        if message.giaddr != '0.0.0.0':
+            return message.giaddr, self.listen_port, None
+        if reply.option53.value == DHCPOption53.DHCPNAK:
+            return BROADCAST, client_port, None
+        if message.ciaddr != '0.0.0.0':
+            return message.ciaddr, client_port, None
+        if message.flags & DHCPMessage.BROADCAST_FLAG:
+            return BROADCAST, client_port, None
+        if self.udp_server.UNICAST_TO_CHADDR:
+            return reply.yiaddr, client_port, message.chaddr
+        return BROADCAST, client_port, None
+
+    def _now(self):
+        return int(self.clock())
+
+    def _get_free_ip(self, chaddr, xid, decision=None):
+        share = self.replicator.share() if self.replicator else None
+        bounds = None
+        if decision and decision.pool:
+            bounds = tuple(self.leases.index(addr) for addr in decision.pool)
+            if None in bounds:
+                return None
+        index = self.leases.offer(mac_to_int(chaddr), xid, self.OFFER_TIMEOUT,
+                                  now=self._now(), share=share, bounds=bounds)
+        if index is None:
             return None
-        lease = self.leases.get(req_ip if req_ip else message.option50.value)
-        if not lease:
+        return self.leases.address(index).exploded
+
+    def _get_lease(self, message, req_ip=None):
+        """Returns the slot index of the binding the message refers to."""
+        if not message.option54 or \
+                message.option54.value != self.config.identifier.exploded:
             return None
-        if check_xid and message.xid != lease['_xid']:
+        index = self.leases.index(req_ip if req_ip else message.option50.value)
+        if index is None:
             return None
-        if message.chaddr != lease['chaddr']:
+        return index
+
+    def _reply_options(self, decision):
+        server_options, decisions = self._reply_sets
+        if not decision or not decision.options:
+            return server_options
+        options = decisions.get(decision)
+        if options is None:
+            options = [decision.options.get(option.code, option)
+                       for option in server_options]
+            codes = {option.code for option in server_options}
+            options.extend(option for code, option in decision.options.items()
+                           if code not in codes)
+            options = [option if isinstance(option, PackedOption)
+                       else PackedOption(option) for option in options]
+            decisions[decision] = options
+        return options
+
+    @staticmethod
+    def _relay_options(message):
+        """Returns the relay agent information to echo (RFC 3046 2.2)."""
+        return (message.option82,) if message.option82 else ()
+
+    def _lease_time(self, decision):
+        if decision and DHCPOption51.code in decision.options:
+            return decision.options[DHCPOption51.code].value
+        return self.config.lease_time
+
+    def dhcp_discover_handler(self, message, decision=None):
+        if self.replicator and not self.replicator.serves(message.chaddr):
             return None
-        return lease
-
-    def dhcp_discover_handler(self, message):
-        yiaddr = self._get_free_ip(message.chaddr, message.xid)
+        yiaddr = self._get_free_ip(message.chaddr, message.xid, decision)
         if not yiaddr:
             return None
         offer_message = DHCPMessage.from_message(
             message,
             op=DHCPMessage.BOOTREPLY,
             yiaddr=yiaddr,
-            options=(DHCPOption53(DHCPOption53.DHCPOFFER), *self.options)
+            options=(DHCPOption53(DHCPOption53.DHCPOFFER),
+                     *self._reply_options(decision),
+                     *self._relay_options(message))
         )
         return offer_message
 
-    def dhcp_request_handler(self, message):
-        lease = self._get_lease(message)
-        if lease:
-            ack_message = DHCPMessage.from_message(
-                message,
-                op=DHCPMessage.BOOTREPLY,
-                yiaddr=message.option50.value,
-                options=(DHCPOption53(DHCPOption53.DHCPACK), *self.options)
-            )
-            dt_now = datetime.datetime.now()
-            delta = datetime.timedelta(seconds=self.config.lease_time)
-            lease.update(
-                state=self.ACTIVE,
-                start_time=dt_now,
-                end_time=dt_now + delta
-            )
-            return ack_message
-        return None
+    def dhcp_request_handler(self, message, decision=None):
+        if not message.option54 and message.ciaddr != '0.0.0.0':
+            return self._dhcp_renew_handler(message, decision)
+        index = self._get_lease(message)
+        if index is None:
+            return None
+        if not self.leases.bind(index, mac_to_int(message.chaddr),
+                                message.xid, self._lease_time(decision),
+                                now=self._now()):
+            return None
+        ack_message = DHCPMessage.from_message(
+            message,
+            op=DHCPMessage.BOOTREPLY,
+            yiaddr=message.option50.value,
+            options=(DHCPOption53(DHCPOption53.DHCPACK),
+                     *self._reply_options(decision),
+                     *self._relay_options(message))
+        )
+        return ack_message
+
+    def _dhcp_renew_handler(self, message, decision=None):
+        """Extends the lease of a RENEWING/REBINDING client (ciaddr set)."""
+        index = self.leases.index(message.ciaddr)
+        if index is None:
+            return None
+        now = self._now()
+        if self.leases.state(index, now) != self.ACTIVE:
+            return None
+        if not self.leases.bind(index, mac_to_int(message.chaddr), None,
+                                self._lease_time(decision), now=now):
+            return None
+        ack_message = DHCPMessage.from_message(
+            message,
+            op=DHCPMessage.BOOTREPLY,
+            yiaddr=message.ciaddr,
+            options=(DHCPOption53(DHCPOption53.DHCPACK),
+                     *self._reply_options(decision),
+                     *self._relay_options(message))
+        )
+        return ack_message
 
     def dhcp_release_handler(self, message):
-        lease = self._get_lease(message, check_xid=False,
-                                req_ip=message.ciaddr)
-        if lease:
-            lease['state'] = self.FREE
+        index = self._get_lease(message, req_ip=message.ciaddr)
+        if index is not None:
+            self.leases.release(index, mac_to_int(message.chaddr))
 
     def dhcp_decline_handler(self, message):
-        lease = self._get_lease(message, check_xid=False)
-        if lease:
-            lease['state'] = self.ACTIVE
+        index = self._get_lease(message)
+        if index is not None:
+            self.leases.decline(index, mac_to_int(message.chaddr))
+
+    def dhcp_leasequery_handler(self, message, ip_port):
+        """Answers a RFC 4388 DHCPLEASEQUERY, needs a LeaseIndex.
+
+        The reply goes to the relay agent or, for a direct query, back to
+        the source of the message: ciaddr holds the queried address.
+
+        """
+        if not self.lease_index:
+            return
+        reply = self.lease_index.leasequery(message)
+        if message.giaddr != '0.0.0.0':
+            addr, port = message.giaddr, self.listen_port
+        else:
+            addr, port = ip_port
+        self.udp_server.send_data(reply.pack(), port, addr)
 
     def _update_leases(self):
-        for lease in self.leases.values():
-            if datetime.datetime.now() > lease['end_time']:
-                lease['state'] = self.FREE
+        """Sweeps expired bindings.
+
+        Not required for correctness: the lease table treats expired slots
+        as FREE on access, so the handler no longer calls it per packet.
+
+        """
+        self.leases.expire(now=self._now())
@@ -0,0 +1,266 @@
+"""Deterministic discrete-event simulation of DHCPServer lease logic.
+
+The server runs with a virtual clock and a MemoryUDPServer transport, so a
+synthetic client population can be driven through the full message path
+(pack, handler, parse) at CPU speed. Clients arrive as a Poisson process,
+renew at T1 (half of the lease time) and leave after an exponentially
+distributed stay, either with a DHCPRELEASE or silently.
+
+"""
+import time
+import heapq
+import random
+
+from .lease import int_to_mac
+from .message import DHCPMessage
+from .udp import MemoryUDPServer
+from .server import DHCPServer
+from .options import DHCPOption53, DHCPOption50, DHCPOption54
+
+
+CLIENT_PORT = 68
+MAC_BASE = 0x020000000000
+MAX_XID = 0xffffffff
+
+# Event kinds.
+ARRIVE = 0
+RENEW = 1
+LEAVE = 2
+SAMPLE = 3
+
+
+class VirtualClock(object):
+    """Callable clock that only moves when the simulation advances it."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SimulationResult(object):
+
+    FILL_BUCKETS = 10
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.utilization = []
+        self.allocation_times = [[] for _ in range(self.FILL_BUCKETS)]
+        self.violations = []
+        self.messages = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return '{}(MESSAGES: {} ELAPSED: {:.2f}s VIOLATIONS: {})'.format(
+            self.__class__.__name__, self.messages, self.elapsed,
+            len(self.violations)
+        )
+
+    def add_allocation(self, fill, seconds):
+        bucket = min(int(fill * self.FILL_BUCKETS), self.FILL_BUCKETS - 1)
+        self.allocation_times[bucket].append(seconds)
+
+    def allocation_report(self):
+        """Returns (fill from, fill to, count, mean seconds) per bucket."""
+        report = []
+        for bucket, times in enumerate(self.allocation_times):
+            report.append((
+                bucket / self.FILL_BUCKETS,
+                (bucket + 1) / self.FILL_BUCKETS,
+                len(times),
+                sum(times) / len(times) if times else 0.0
+            ))
+        return report
+
+
+class Simulator(object):
+    """Drives a DHCPServer with a synthetic client population."""
+
+    def __init__(self, config, clients, arrival_rate, mean_stay,
+                 release_ratio=0.8, sample_interval=60.0, seed=0):
+        """Simulator initial.
+
+        :param config: DHCPServerConfig instance
+        :param clients: size of the client population
+        :param arrival_rate: arrivals of idle clients per second
+        :param mean_stay: mean seconds a client stays on the network
+        :param release_ratio: share of clients sending DHCPRELEASE on leave
+        :param sample_interval: seconds between utilization samples
+        :param seed: random seed, equal seeds give equal runs
+
+        """
+        self.clock = VirtualClock()
+        self.server = DHCPServer(config, transport=MemoryUDPServer,
+                                 clock=self.clock)
+        self.config = config
+        self.identifier = config.identifier.exploded
+        self._excluded = {addr.exploded for addr in config.excluded_addr}
+        self.clients = clients
+        self.arrival_rate = arrival_rate
+        self.mean_stay = mean_stay
+        self.release_ratio = release_ratio
+        self.sample_interval = sample_interval
+        self.random = random.Random(seed)
+        self._events = []
+        self._sequence = 0
+        self._idle = list(range(clients))
+        # Client -> (ip, xid, lease end) as the clients see it.
+        self._bound = {}
+        # IP -> (client, lease end) of addresses the server must not reuse.
+        self._held = {}
+        reserved = sum(
+            1 for addr in config.excluded_addr
+            if self.server.leases.index(addr) is not None
+        )
+        self.result = SimulationResult(len(self.server.leases) - reserved)
+
+    def run(self, duration):
+        """Runs the simulation for 'duration' virtual seconds."""
+        started = time.perf_counter()
+        self._schedule(0.0, SAMPLE)
+        self._schedule_arrival()
+        while self._events and self._events[0][0] <= duration:
+            timestamp, _, kind, client = heapq.heappop(self._events)
+            self.clock.now = timestamp
+            if kind == ARRIVE:
+                self._arrive()
+            elif kind == RENEW:
+                self._renew(client)
+            elif kind == LEAVE:
+                self._leave(client)
+            elif kind == SAMPLE:
+                self._sample()
+        self.result.elapsed = time.perf_counter() - started
+        return self.result
+
+    def _schedule(self, timestamp, kind, client=None):
+        self._sequence += 1
+        heapq.heappush(self._events, (timestamp, self._sequence, kind, client))
+
+    def _schedule_arrival(self):
+        self._schedule(
+            self.clock.now + self.random.expovariate(self.arrival_rate),
+            ARRIVE
+        )
+
+    def _send(self, message):
+        sent = self.server.udp_server.sent
+        sent.clear()
+        self.server.handler((message.pack(), ('0.0.0.0', CLIENT_PORT)))
+        self.result.messages += 1
+        if not sent:
+            return None
+        return DHCPMessage.from_bytes(sent[-1][0])
+
+    def _violation(self, text, client):
+        self.result.violations.append((self.clock.now, client, text))
+
+    def _lease_end(self):
+        return int(self.clock.now) + self.config.lease_time
+
+    def _purge_held(self):
+        now = int(self.clock.now)
+        expired = [ip for ip, (_, end) in self._held.items() if now > end]
+        for ip in expired:
+            del self._held[ip]
+
+    def _arrive(self):
+        self._schedule_arrival()
+        if not self._idle:
+            return
+        client = self._idle.pop(self.random.randrange(len(self._idle)))
+        mac = int_to_mac(MAC_BASE + client)
+        self._purge_held()
+        fill = len(self._held) / self.result.pool_size
+
+        discover = DHCPMessage(
+            DHCPMessage.BOOTREQUEST, xid=self.random.randint(1, MAX_XID),
+            chaddr=mac,
+            options=(DHCPOption53(DHCPOption53.DHCPDISCOVER),)
+        )
+        start = time.perf_counter()
+        offer = self._send(discover)
+        self.result.add_allocation(fill, time.perf_counter() - start)
+        if not offer:
+            if len(self._held) < self.result.pool_size:
+                self._violation('No offer while the pool has free addresses',
+                                client)
+            self._idle.append(client)
+            return
+        if self.server.leases.index(offer.yiaddr) is None:
+            self._violation('Offered {} out of the pool'.format(offer.yiaddr),
+                            client)
+        if offer.yiaddr in self._excluded:
+            self._violation('Offered excluded {}'.format(offer.yiaddr),
+                            client)
+        holder = self._held.get(offer.yiaddr)
+        if holder and holder[0] != client:
+            self._violation('Offered {} held by client {}'.format(
+                offer.yiaddr, holder[0]), client)
+
+        request = DHCPMessage(
+            DHCPMessage.BOOTREQUEST, xid=discover.xid, chaddr=mac,
+            options=(DHCPOption53(DHCPOption53.DHCPREQUEST),
+                     DHCPOption50(offer.yiaddr),
+                     DHCPOption54(self.identifier))
+        )
+        ack = self._send(request)
+        if not ack or ack.option53.value != DHCPOption53.DHCPACK:
+            self._violation('No DHCPACK for offered {}'.format(offer.yiaddr),
+                            client)
+            self._idle.append(client)
+            return
+        end = self._lease_end()
+        self._bound[client] = (ack.yiaddr, discover.xid, end)
+        self._held[ack.yiaddr] = (client, end)
+        stay = self.random.expovariate(1.0 / self.mean_stay)
+        self._schedule(self.clock.now + stay, LEAVE, client)
+        self._schedule(self.clock.now + self.config.lease_time / 2, RENEW,
+                       (client, discover.xid))
+
+    def _renew(self, binding):
+        client, binding_xid = binding
+        if client not in self._bound:
+            return
+        ip, xid, _ = self._bound[client]
+        if xid != binding_xid:
+            return
+        request = DHCPMessage(
+            DHCPMessage.BOOTREQUEST, chaddr=int_to_mac(MAC_BASE + client),
+            ciaddr=ip, flags=DHCPMessage.UNICAST_FLAG,
+            options=(DHCPOption53(DHCPOption53.DHCPREQUEST),)
+        )
+        ack = self._send(request)
+        if not ack or ack.option53.value != DHCPOption53.DHCPACK:
+            self._violation('Renewal of {} refused'.format(ip), client)
+            return
+        end = self._lease_end()
+        self._bound[client] = (ip, xid, end)
+        self._held[ip] = (client, end)
+        self._schedule(self.clock.now + self.config.lease_time / 2, RENEW,
+                       binding)
+
+    def _leave(self, client):
+        ip, xid, _ = self._bound.pop(client)
+        self._idle.append(client)
+        if self.random.random() >= self.release_ratio:
+            return
+        release = DHCPMessage(
+            DHCPMessage.BOOTREQUEST, chaddr=int_to_mac(MAC_BASE + client),
+            ciaddr=ip,
+            options=(DHCPOption53(DHCPOption53.DHCPRELEASE),
+                     DHCPOption54(self.identifier))
+        )
+        self._send(release)
+        # The entry is gone if the lease ran out (refused renewal) and may
+        # belong to another client since.
+        if self._held.get(ip, (None,))[0] == client:
+            del self._held[ip]
+
+    def _sample(self):
+        self._purge_held()
+        self.result.utilization.append(
+            (self.clock.now, len(self._held) / self.result.pool_size)
+        )
+        self._schedule(self.clock.now + self.sample_interval, SAMPLE)
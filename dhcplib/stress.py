@@ -0,0 +1,149 @@
+"""Multi-threaded stress test and contention benchmark of the lease store.
+
+    python -m dhcplib.stress
+
+runs the stress test at 1, 4 and 16 threads and prints the throughput of
+ConcurrentLeaseTable against the same table with a single lock stripe.
+
+"""
+import sys
+import time
+import random
+import threading
+
+from .lease import LeaseTable, ConcurrentLeaseTable
+
+
+POOL = ('10.0.0.1', '10.0.3.254')
+MAC_BASE = 0x020000000000
+LEASE_TIME = 3600
+OFFER_TIMEOUT = 60
+
+
+class StressResult(object):
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.operations = 0
+        self.elapsed = 0.0
+        self.violations = []
+
+    def __str__(self):
+        return '{}(THREADS: {} OPS/S: {:.0f} VIOLATIONS: {})'.format(
+            self.__class__.__name__, self.threads, self.throughput,
+            len(self.violations)
+        )
+
+    @property
+    def throughput(self):
+        return self.operations / self.elapsed if self.elapsed else 0.0
+
+
+def run_stress(threads, operations=2000, clients=1500, shared_clients=32,
+               table=None, seed=0):
+    """Runs offer/bind/release churn on 'threads' threads at once.
+
+    Every thread owns its clients and also uses 'shared_clients' clients
+    common to all threads, so one client's DHCPDISCOVERs race each other.
+    The pool is smaller than the population, so offers race for the last
+    free slots. Afterwards these invariants are checked:
+
+    - every binding a client believes it holds is in the table under its
+      chaddr (otherwise the address was offered twice);
+    - no client occupies more than one slot.
+
+    :param table: lease table to use, a new ConcurrentLeaseTable by default
+
+    """
+    table = table or ConcurrentLeaseTable(*POOL)
+    result = StressResult(threads)
+    holdings = [dict() for _ in range(threads)]
+    per_thread = clients // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(number):
+        rng = random.Random(seed * 1000 + number)
+        own = [MAC_BASE + shared_clients + number * per_thread + offset
+               for offset in range(per_thread)]
+        held = holdings[number]
+        barrier.wait()
+        for _ in range(operations):
+            if rng.random() < 0.1:
+                chaddr = MAC_BASE + rng.randrange(shared_clients)
+                table.offer(chaddr, 0, OFFER_TIMEOUT, now=0)
+                continue
+            chaddr = rng.choice(own)
+            if chaddr in held:
+                if rng.random() < 0.5:
+                    table.release(held.pop(chaddr), chaddr)
+                continue
+            xid = rng.getrandbits(32)
+            index = table.offer(chaddr, xid, OFFER_TIMEOUT, now=0)
+            if index is not None and table.bind(index, chaddr, xid,
+                                                LEASE_TIME, now=0):
+                held[chaddr] = index
+
+    workers = [threading.Thread(target=worker, args=(number,))
+               for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    result.elapsed = time.perf_counter() - started
+    result.operations = threads * operations
+
+    owners = {}
+    for held in holdings:
+        for chaddr, index in held.items():
+            state, slot_chaddr, _, _ = table.slot(index)
+            if slot_chaddr != chaddr or state != LeaseTable.ACTIVE:
+                result.violations.append(
+                    'Slot {} of {:012X} taken by {:012X}'.format(
+                        index, chaddr, slot_chaddr)
+                )
+            if index in owners:
+                result.violations.append(
+                    'Slot {} held by {:012X} and {:012X}'.format(
+                        index, owners[index], chaddr)
+                )
+            owners[index] = chaddr
+    slots = {}
+    for index in range(len(table)):
+        state, chaddr, _, _ = table.slot(index)
+        if state in (LeaseTable.OFFERED, LeaseTable.ACTIVE):
+            slots.setdefault(chaddr, []).append(index)
+    for chaddr, indexes in slots.items():
+        if len(indexes) > 1:
+            result.violations.append('{:012X} occupies slots {}'.format(
+                chaddr, indexes))
+    return result
+
+
+def benchmark(thread_counts=(1, 4, 16), operations=2000):
+    """Returns (threads, striped ops/s, single lock ops/s, violations)."""
+    rows = []
+    for threads in thread_counts:
+        striped = run_stress(threads, operations)
+        single = run_stress(threads, operations,
+                            table=ConcurrentLeaseTable(*POOL, stripes=1))
+        rows.append((threads, striped.throughput, single.throughput,
+                     striped.violations + single.violations))
+    return rows
+
+
+def main():
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('GIL enabled: {}'.format(gil))
+    print('{:>8} {:>14} {:>14} {:>11}'.format(
+        'threads', 'striped ops/s', '1 lock ops/s', 'violations'))
+    for threads, striped, single, violations in benchmark():
+        print('{:>8} {:>14.0f} {:>14.0f} {:>11}'.format(
+            threads, striped, single, len(violations)))
+        for violation in violations:
+            print('    ' + violation)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
 import socket
+from collections import deque
+
+
+BROADCAST = '<broadcast>'
 
 
 class BaseUDPBroadcastServer(object):
 
     BUFFER = 1024
 
+    # An IP socket cannot address a client that has no IP address yet.
+    UNICAST_TO_CHADDR = False
+
     def __init__(self, listen_port, timeout=None):
         self._listen_port = listen_port
         self._timeout = timeout
@@ -16,8 +23,8 @@ class BaseUDPBroadcastServer(object):
         self._sock.settimeout(self._timeout)
         self._sock.bind(('', self._listen_port))
 
-    def send_data(self, data, port):
-        self._sock.sendto(data, ('<broadcast>', port))
+    def send_data(self, data, port, addr=BROADCAST, chaddr=None):
+        self._sock.sendto(data, (addr, port))
 
     def received_data(self):
         return self._sock.recvfrom(self.BUFFER)
@@ -35,3 +42,40 @@ class UDPServer(BaseUDPBroadcastServer):
     def start_handle(self):
         while True:
             self._proto_handler(self.received_data())
+
+
+class MemoryUDPServer(object):
+    """Socket-free counterpart of UDPServer.
+
+    Datagrams are fed in with 'feed' and the data passed to 'send_data' is
+    collected in 'sent' as (data, port, addr) tuples.
+
+    """
+
+    UNICAST_TO_CHADDR = False
+
+    def __init__(self, listen_port, proto_handler, timeout=None):
+        self._listen_port = listen_port
+        self._proto_handler = proto_handler
+        self._timeout = timeout
+        self.inbox = deque()
+        self.sent = deque()
+
+    def feed(self, payload, ip_port):
+        self.inbox.append((payload, ip_port))
+
+    def send_data(self, data, port, addr=BROADCAST, chaddr=None):
+        self.sent.append((data, port, addr))
+
+    def received_data(self):
+        try:
+            return self.inbox.popleft()
+        except IndexError:
+            raise socket.timeout('No data to receive')
+
+    def stop(self):
+        self.inbox.clear()
+
+    def start_handle(self):
+        while self.inbox:
+            self._proto_handler(self.inbox.popleft())